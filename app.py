@@ -1,243 +1,93 @@
 import os
-import json
+import hmac
 import uuid
-import datetime
-import requests
-import imaplib
-import email
-from email.header import decode_header
-from flask import Flask, request, redirect
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, redirect, jsonify
 from apscheduler.schedulers.background import BackgroundScheduler
-from linebot import LineBotApi, WebhookHandler
+from linebot import WebhookParser
+from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
+import engine
+from engine import (
+    CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, line_bot_api, user_store, build_auth_url, poll_scheduler, poller_ready,
+)
+import metrics
+import auth_health
+import jobs
+from imap_utils import SYNC_KEYS
+from token_manager import TOKEN_URL, HTTP_TIMEOUT, expiry_after, session as http_session
 
 
-LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET")
-CLIENT_ID = os.environ.get("CLIENT_ID")
-CLIENT_SECRET = os.environ.get("CLIENT_SECRET")
-REDIRECT_URI = os.environ.get("REDIRECT_URI")
-USERS_FILE = "./persistent/users.json"
-COUNT_FILE = "./persistent/notify_counts.json"
-NOTIFY_LIMIT = 30
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))
+# 0 にすると、このプロセスではメールチェックをしない（checker.py のワーカーを別に動かす場合）
+RUN_POLLER = os.environ.get("RUN_POLLER", "1") == "1"
+# 管理用 API（/admin/jobs・/test-main）には「Authorization: Bearer <ADMIN_TOKEN>」が必要（未設定なら使えない）
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 
 app = Flask(__name__)
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
-
-
-def is_user_ready(user):
-    required_keys = ["LINE_USER_ID", "EMAIL_ADDRESS", "access_token", "refresh_token"]
-    for key in required_keys:
-        if not user.get(key):
-            print(f"[{user.get('LINE_USER_ID', '不明')}] ⚠️ 必須キー {key} が未設定のためスキップ")
-            return False
-    return True
-
-def generate_oauth2_string(email_address, access_token):
-    return f"user={email_address}\1auth=Bearer {access_token}\1\1".encode()
-
-def refresh_access_token(refresh_token):
-    token_url = "https://oauth2.googleapis.com/token"
-    data = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "refresh_token": refresh_token,
-        "grant_type": "refresh_token",
-    }
-    res = requests.post(token_url, data=data)
-    if res.status_code == 200:
-        return res.json()["access_token"]
-    else:
-        print("トークン更新失敗:", res.text)
-        return None
-    
-def decode_mime_words(s):
-    if not s:
-        return ""
-    decoded_fragments = decode_header(s)
-    decoded_string = ""
-    for fragment, encoding in decoded_fragments:
-        if isinstance(fragment, bytes):
-            decoded_string += fragment.decode(encoding or 'utf-8', errors='ignore')
-        else:
-            decoded_string += fragment
-    return decoded_string
-
-def load_notify_counts():
-    try:
-        with open(COUNT_FILE, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        print("⚠️ 通知回数ファイルが存在しません。初期化します。")
-        return {}
-
-def save_notify_counts(counts):
-    directory = os.path.dirname(COUNT_FILE)  
-    if not os.path.exists(directory):        
-        os.makedirs(directory, exist_ok=True) 
-    with open(COUNT_FILE, "w") as f:         
-        json.dump(counts, f, indent=2, ensure_ascii=False)  
-
-
-def check_email(user, users, counts):
-    if not is_user_ready(user):
-        return
-
-    line_user_id = user["LINE_USER_ID"]
-    if counts.get(line_user_id, 0) >= NOTIFY_LIMIT:
-        print(f"[{line_user_id}] ⚠️ 通知上限（{NOTIFY_LIMIT}回）に達しています。通知をスキップします。")
-        return
-
-    email_address = user["EMAIL_ADDRESS"]
-    access_token = user["access_token"]
-    refresh_token = user["refresh_token"]
-    imap_server = user.get("IMAP_SERVER", "imap.gmail.com")
-    imap_port = user.get("IMAP_PORT", 993)
-
-    try:
-        mail = imaplib.IMAP4_SSL(imap_server, imap_port)
-        mail.authenticate("XOAUTH2", lambda x: generate_oauth2_string(email_address, access_token))
-        mail.select("inbox")
-    except imaplib.IMAP4.error:
-        print(f"[{line_user_id}] IMAP認証失敗。リフレッシュを試みます")
-        new_token = refresh_access_token(refresh_token)
-        if new_token:
-            user["access_token"] = new_token
-            save_users(users)
-            try:
-                mail = imaplib.IMAP4_SSL(imap_server, imap_port)
-                mail.authenticate("XOAUTH2", lambda x: generate_oauth2_string(email_address, new_token))
-                mail.select("inbox")
-            except imaplib.IMAP4.error as e2:
-                print(f"[{line_user_id}] リフレッシュ後も認証失敗:", e2)
-                return
-        else:
-            return
-
-    status, messages = mail.search(None, "UNSEEN")
-    if status != "OK":
-        print(f"[{line_user_id}] メール検索失敗")
-        mail.logout()
-        return
-
-    email_ids = messages[0].split()
-    if not email_ids:
-        print(f"[{line_user_id}] 未読メールなし")
-        mail.logout()
-        return
-
-    subjects = []
-    for num in email_ids[:5]:  # 最大5件
-        status, data = mail.fetch(num, "(RFC822)")
-        if status != "OK":
-            continue
-        for response_part in data:
-            if isinstance(response_part, tuple):
-                msg = email.message_from_bytes(response_part[1])
-                subject = decode_mime_words(msg["Subject"])
-                raw_from = msg.get("From", "不明")
-                from_ = decode_mime_words(raw_from)  # ←ここを追加してデコードする
-                subjects.append(f"{from_} / {subject}")
-
-    others = len(email_ids) - 5
-    subject_text = "\n".join(subjects)
-    if others > 0:
-        subject_text += f"\n他 {others} 件の未読メールあり"
-
-    for num in email_ids:
-        mail.store(num, '+FLAGS', '\\Seen')
-    print("✅ 未読メールを既読にしました。")
-        
-
-    notify_count = counts.get(line_user_id, 0) + 1
-    counts[line_user_id] = notify_count
-    save_notify_counts(counts)
-
-    message = (
-        "📩 新着メール通知\n\n"
-        + "\n".join([f"👤 {line.split(' / ')[0]}\n📝 {line.split(' / ')[1]}" for line in subjects])
-        + (f"\n\n他 {others} 件の未読メールあり" if others > 0 else "")
-        + "\n\n-----\n\n"
-        + f"✅ 通知回数：{notify_count}/{NOTIFY_LIMIT}回\n\n"
-        + "通知上限に達した場合は、\n"
-        + "X（旧Twitter）のDMでご連絡ください。\n"
-        + "👉 https://x.com/job_akira\n\n"
-        + "※今後プレミアムプラン（通知回数無制限）も予定しています。\n\n"
-        + "-----\n\n"
-        + "🙏 メル通知の運営は皆様の応援で継続できています。\n"
-        + "もしサービスの継続・発展を応援いただける場合は、\n"
-        + "100円から支援いただけるととても励みになります。\n\n"
-        + "👉 https://qr.paypay.ne.jp/p2p01_NiHbdLbDfyqQRRa0"
-    )
-    
-    line_bot_api.push_message(line_user_id, TextSendMessage(text=message))
-    print(f"[{line_user_id}] メール通知送信完了")
-
-    mail.logout()
-
-def load_users():
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'r') as f:
-            return json.load(f)
-    return []
-
-def save_users(users):
-    directory = os.path.dirname(USERS_FILE) 
-    if not os.path.exists(directory):      
-        os.makedirs(directory, exist_ok=True)  
-    with open(USERS_FILE, 'w') as f:       
-        json.dump(users, f, indent=2)       
+parser = WebhookParser(LINE_CHANNEL_SECRET)
+# Webhook のイベントは応答を返した後にこのスレッドプールで処理する
+webhook_pool = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
 
 
 def find_user_by_line_id(line_user_id):
-    users = load_users()
-    for user in users:
-        if user.get("LINE_USER_ID") == line_user_id:
-            return user
-    return None
+    return user_store.get(line_user_id)
 
 def find_user_by_state(state):
-    users = load_users()
-    for user in users:
-        if user.get("state") == state:
-            return user
-    return None
+    return user_store.find_by_state(state)
 
 def update_user_tokens(state, access_token, refresh_token, token_expiry, email_address):
-    users = load_users()
-    for user in users:
-        if user.get("state") == state:
-            user["access_token"] = access_token
-            user["refresh_token"] = refresh_token
-            user["token_expiry"] = token_expiry
-            user["EMAIL_ADDRESS"] = email_address
-            user["IMAP_SERVER"] = "imap.gmail.com"
-            user["IMAP_PORT"] = 993
-            break
-    save_users(users)
+    # 別のメールアドレスで認証し直した場合は、前のメールボックスの同期状態（UID など）を捨ててフル再同期させる
+    user = find_user_by_state(state)
+    sync_reset = {}
+    if user and (user.get("EMAIL_ADDRESS") or "").lower() != email_address.lower():
+        sync_reset = dict.fromkeys(SYNC_KEYS)
+    user_store.update_by_state(
+        state,
+        access_token=access_token,
+        refresh_token=refresh_token,
+        token_expiry=token_expiry,
+        EMAIL_ADDRESS=email_address,
+        IMAP_SERVER="imap.gmail.com",
+        IMAP_PORT=993,
+        **auth_health.reset(),
+        **sync_reset,
+    )
 
 
 # === LINE Webhook ===
 @app.route("/line-callback", methods=["POST"])
+@metrics.timed("http_request_seconds", route="/line-callback")
 def callback():
     signature = request.headers.get("X-Line-Signature")
     body = request.get_data(as_text=True)
     try:
-        handler.handle(body, signature)
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        print("LINE callback error: 署名が不正です")
+        return "Error", 400
     except Exception as e:
         print(f"LINE callback error: {e}")
         return "Error", 500
-    return "OK"
 
-def main():
-    users = load_users()
-    counts = load_notify_counts()
-    for user in users:
-        check_email(user, users, counts)
+    for event in events:
+        event_id = getattr(event, "webhook_event_id", None)
+        if event_id and not user_store.claim_webhook_event(event_id):
+            print(f"LINE callback: 再送イベントをスキップ {event_id}")
+            metrics.inc("webhook_events_total", result="duplicate")
+            continue
+        webhook_pool.submit(dispatch_event, event)
+        metrics.inc("webhook_events_total", result="dispatched")
+    return "OK"
 
+def dispatch_event(event):
+    try:
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+            handle_message(event)
+    except Exception as e:
+        print(f"LINE event error: {e}")
 
-@handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     line_user_id = event.source.user_id
     user = find_user_by_line_id(line_user_id)
@@ -245,8 +95,7 @@ def handle_message(event):
     # === 【分岐①】ユーザー未登録（初回接触） ===
     if not user:
         state = str(uuid.uuid4())
-        users = load_users()
-        users.append({
+        user_store.add({
             "LINE_USER_ID": line_user_id,
             "state": state,
             "EMAIL_ADDRESS": "",
@@ -256,7 +105,6 @@ def handle_message(event):
             "refresh_token": "",
             "token_expiry": ""
         })
-        save_users(users)
 
         message = (
             "✅ はじめまして！『メル通知』運営です。\n\n"
@@ -271,20 +119,13 @@ def handle_message(event):
         return  # 初回はここで終了
 
     # === 【分岐②】認証状態チェック ===
-    is_authenticated = user.get("EMAIL_ADDRESS") and user.get("access_token")
+    is_authenticated = (
+        user.get("EMAIL_ADDRESS") and user.get("access_token")
+        and auth_health.health(user) != auth_health.OPEN
+    )
 
     if not is_authenticated:
-        state = user["state"]
-        auth_url = (
-            f"https://accounts.google.com/o/oauth2/v2/auth"
-            f"?client_id={CLIENT_ID}"
-            f"&redirect_uri={REDIRECT_URI}"
-            f"&response_type=code"
-            f"&scope=https://mail.google.com/ https://www.googleapis.com/auth/userinfo.email"
-            f"&access_type=offline"
-            f"&prompt=consent"
-            f"&state={state}"
-        )
+        auth_url = build_auth_url(user["state"])
         message = (
             "🔑 【Google認証のお願い】\n\n"
             "下記URLから認証し、受信したいGmailアカウントでログインしてください。\n\n"
@@ -307,12 +148,12 @@ def handle_message(event):
 
 # === Google OAuth コールバック ===
 @app.route('/callback')
+@metrics.timed("http_request_seconds", route="/callback")
 def oauth2callback():
     code = request.args.get('code')
     state = request.args.get('state')
 
     # トークン取得
-    token_url = 'https://oauth2.googleapis.com/token'
     data = {
         'code': code,
         'client_id': CLIENT_ID,
@@ -320,7 +161,7 @@ def oauth2callback():
         'redirect_uri': REDIRECT_URI,
         'grant_type': 'authorization_code'
     }
-    r = requests.post(token_url, data=data)
+    r = http_session.post(TOKEN_URL, data=data, timeout=HTTP_TIMEOUT)
     token_response = r.json()
 
     access_token = token_response.get("access_token")
@@ -330,12 +171,13 @@ def oauth2callback():
     if not access_token or not refresh_token:
         return "認証に失敗しました。"
 
-    expiry_time = (datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in)).isoformat()
+    expiry_time = expiry_after(expires_in)
 
     # ユーザー情報取得
-    userinfo_response = requests.get(
+    userinfo_response = http_session.get(
         "https://www.googleapis.com/oauth2/v2/userinfo",
-        headers={"Authorization": f"Bearer {access_token}"}
+        headers={"Authorization": f"Bearer {access_token}"},
+        timeout=HTTP_TIMEOUT,
     )
     userinfo = userinfo_response.json()
     email_address = userinfo.get("email")
@@ -348,34 +190,78 @@ def oauth2callback():
 
     return "Google認証が完了しました！LINEで通知が届きます。"
 
+# === 管理用のメールチェックのジョブ ===
+# Web 側は users.db にジョブを登録するだけで、チェックはメールチェック担当のプロセスが行う（jobs.py）
+def is_admin():
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {ADMIN_TOKEN}")
+
+def submit_job(line_user_ids=None):
+    job, created = jobs.submit(user_store, line_user_ids)
+    if created and RUN_POLLER:
+        # 同じプロセスでチェックしている場合は、次の定期実行を待たずに始める
+        engine.wake(scheduler)
+    return job, created
+
+@app.route('/admin/jobs', methods=["POST"])
+def create_job():
+    if not is_admin():
+        return "Forbidden", 403
+    # {"users": ["LINE_USER_ID", ...]} で対象を絞れる（省略すると登録ユーザー全員）
+    line_user_ids = (request.get_json(silent=True) or {}).get("users")
+    if line_user_ids is not None and (
+        not isinstance(line_user_ids, list) or not all(isinstance(uid, str) for uid in line_user_ids)
+    ):
+        return jsonify(error="users には LINE_USER_ID の配列を指定してください"), 400
+    job, created = submit_job(line_user_ids)
+    return jsonify(job), (202 if created else 409)
+
+@app.route('/admin/jobs/<job_id>')
+def get_job(job_id):
+    if not is_admin():
+        return "Forbidden", 403
+    job = jobs.get(user_store, job_id)
+    if job is None:
+        return jsonify(error="ジョブが見つかりません"), 404
+    return jsonify(job)
+
 @app.route('/test-main')
 def test_main():
+    if not is_admin():
+        return "Forbidden", 403
     print("===== /test-main accessed, main() will run =====")
-    main()
-    return "main() executed"
+    job, _ = submit_job()
+    return f"main() queued: /admin/jobs/{job['id']}", 202
 
 # === ルート（/）にアクセスしたときの表示 ===
 @app.route('/')
 def home():
     return 'Merutsuuchi は正常に動作中です！'
 
-from apscheduler.schedulers.background import BackgroundScheduler
-
-print("🟡 Starting main() before scheduler")
-main()
-print("🟡 main() done, initializing scheduler")
-
-scheduler = BackgroundScheduler(timezone="Asia/Tokyo")
-
-@scheduler.scheduled_job('interval', minutes=5)
-def scheduled_job():
-    print("🟢 Scheduled job started")
-    main()
-    print("🟢 Scheduled job finished")
-
-print("🟡 Starting scheduler")
-scheduler.start()
-print("🟡 Scheduler started")
+# === 起動後の初回メールチェックが終わったか ===
+@app.route('/ready')
+def ready():
+    if not RUN_POLLER:
+        # メールチェックは別プロセスのワーカーが担当する
+        return jsonify(ready=True, poller=False), 200
+    checked, total = poll_scheduler.progress()
+    is_ready = poller_ready.is_set()
+    return jsonify(ready=is_ready, checked=checked, users=total), (200 if is_ready else 503)
+
+# === Prometheus 形式のメトリクス ===
+metrics.gauge("webhook_queue_depth", webhook_pool._work_queue.qsize)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+if RUN_POLLER:
+    scheduler = BackgroundScheduler(timezone="Asia/Tokyo")
+    engine.schedule(scheduler)
+    print("🟡 Starting scheduler")
+    scheduler.start()
+    print("🟡 Scheduler started")
 
 # そして最後のほうに
 if __name__ == "__main__":
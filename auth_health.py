@@ -0,0 +1,47 @@
+import os
+import time
+
+
+# ユーザーごとの認証状態（サーキットブレーカー）。値はユーザー情報に保存する
+HEALTHY = "healthy"    # 問題なし
+DEGRADED = "degraded"  # 更新直後のトークンでも認証に失敗した。auth_retry_at まではチェックしない
+OPEN = "open"          # 再認証が必要。Google 認証をやり直すまで一切通信しない
+
+# 何回続けて失敗したら OPEN にするか（リフレッシュトークンが失効していた場合は即 OPEN）
+AUTH_FAILURE_THRESHOLD = int(os.environ.get("AUTH_FAILURE_THRESHOLD", 3))
+AUTH_RETRY_BACKOFF = (10 * 60, 6 * 60 * 60)
+
+
+def health(user):
+    return user.get("auth_health") or HEALTHY
+
+
+def blocked(user, now=None):
+    # 通信せずにスキップすべきか
+    state = health(user)
+    if state == OPEN:
+        return True
+    if state == DEGRADED:
+        return (now or time.time()) < (user.get("auth_retry_at") or 0)
+    return False
+
+
+def reset():
+    return {"auth_health": HEALTHY, "auth_failures": 0, "auth_retry_at": None, "reauth_prompted": False}
+
+
+def succeeded(user):
+    # 保存すべき変更を返す（すでに healthy なら空）
+    if health(user) == HEALTHY and not user.get("auth_failures"):
+        return {}
+    return reset()
+
+
+def failed(user, revoked=False, now=None):
+    # 認証失敗を1回数え、保存すべき変更を返す
+    failures = (user.get("auth_failures") or 0) + 1
+    if revoked or failures >= AUTH_FAILURE_THRESHOLD:
+        return {"auth_health": OPEN, "auth_failures": failures, "auth_retry_at": None}
+    base, cap = AUTH_RETRY_BACKOFF
+    delay = min(cap, base * 2 ** (failures - 1))
+    return {"auth_health": DEGRADED, "auth_failures": failures, "auth_retry_at": (now or time.time()) + delay}
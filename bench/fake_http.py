@@ -0,0 +1,86 @@
+import json
+import time
+import random
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from fake_imap import Stats
+
+
+# ベンチマーク用のローカル HTTP サーバー。
+# Google のトークンエンドポイント（/token）と LINE の push API（/v2/bot/message/push）の代わりをする。
+# /_bench/* はベンチマークからの操作用（新着メールの追加・集計の取得）
+
+
+class FakeHttpHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/_bench/stats":
+            reset = parse_qs(url.query).get("reset") == ["1"]
+            self._reply(200, self.server.bench_stats(reset))
+        elif url.path == "/oauth2/v2/userinfo":
+            self._reply(200, {"email": "bench@example.com"})
+        else:
+            self._reply(404, {"message": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        server = self.server
+        if url.path == "/_bench/deliver":
+            n = int(parse_qs(url.query).get("n", ["1"])[0])
+            self._reply(200, {"mailboxes": server.imap.deliver(n) if server.imap else 0})
+            return
+
+        if server.latency:
+            time.sleep(server.latency)
+        if url.path == "/token":
+            if b"refresh_token=revoked" in body:
+                server.stats.add("token_revoked")
+                self._reply(400, {"error": "invalid_grant", "error_description": "Token has been expired or revoked."})
+                return
+            n = server.stats.add("token")
+            self._reply(200, {"access_token": f"fresh-{n}", "expires_in": 3600, "token_type": "Bearer"})
+        elif url.path == "/v2/bot/message/push":
+            if server.push_429_ratio and random.random() < server.push_429_ratio:
+                server.stats.add("push_429")
+                self._reply(429, {"message": "Too Many Requests"}, {"Retry-After": "0"})
+                return
+            server.stats.add("push")
+            server.stats.add("push_bytes", len(body))
+            self._reply(200, {})
+        else:
+            self._reply(404, {"message": "not found"})
+
+
+class FakeHttpServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, imap=None, latency=0.0, push_429_ratio=0.0):
+        super().__init__(address, FakeHttpHandler)
+        self.imap = imap
+        self.latency = latency
+        self.push_429_ratio = push_429_ratio
+        self.stats = Stats()
+
+    def bench_stats(self, reset=False):
+        stats = {"http": self.stats.snapshot(reset)}
+        if self.imap:
+            stats["imap"] = self.imap.stats.snapshot(reset)
+        return stats
@@ -0,0 +1,284 @@
+import re
+import ssl
+import time
+import base64
+import threading
+import socketserver
+
+
+# ベンチマーク用のローカル IMAP サーバー（TLS / XOAUTH2 / SEARCH / FETCH / STORE / IDLE）。
+# メールボックスはユーザーごとに遅延生成し、メッセージ本体は持たずヘッダーだけを UID から作る
+
+CAPABILITIES = "IMAP4rev1 AUTH=XOAUTH2 IDLE UIDPLUS CONDSTORE"
+
+_LINE_RE = re.compile(rb"^(\S+) (\S+)(?: (.*))?$")
+_FIELDS_RE = re.compile(r"HEADER\.FIELDS \(([^)]*)\)", re.I)
+
+
+class Mailbox:
+
+    def __init__(self, email_address, size, unread):
+        self.email_address = email_address
+        self.lock = threading.Lock()
+        self.uidvalidity = 1
+        self.uidnext = size + 1
+        self.modseq = 1
+        self.unseen = set(range(max(1, size - unread + 1), size + 1))
+        self.watchers = set()
+
+    def exists(self):
+        return self.uidnext - 1
+
+    def deliver(self, n):
+        with self.lock:
+            for _ in range(n):
+                self.unseen.add(self.uidnext)
+                self.uidnext += 1
+            self.modseq += 1
+            watchers = list(self.watchers)
+        for conn in watchers:
+            conn.untagged(f"* {self.exists()} EXISTS")
+
+    def header(self, uid, fields):
+        k = uid % 97
+        # 差出人は RFC 2047 でエンコードしたものと、エンコードしていない生の UTF-8 を交互に返す
+        sender = "=?UTF-8?B?5bGx55Sw5aSq6YOO?=" if uid % 2 else "山田太郎"
+        values = {
+            "FROM": f"{sender} <sender{k}@example.com>",
+            "SUBJECT": f"=?UTF-8?B?44OG44K544OI?= #{uid} for {self.email_address}",
+            "MESSAGE-ID": f"<{uid}.{self.uidvalidity}.{self.email_address}>",
+            "DATE": "Mon, 1 Jan 2024 09:00:00 +0900",
+        }
+        lines = [f"{name.title()}: {values[name]}" for name in fields if name in values]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+
+def parse_set(spec, top):
+    uids = set()
+    for part in spec.split(","):
+        if ":" in part:
+            a, b = part.split(":", 1)
+            a = top if a == "*" else int(a)
+            b = top if b == "*" else int(b)
+            lo, hi = min(a, b), max(a, b)
+            uids.update(range(lo, min(hi, top) + 1))
+        else:
+            uid = top if part == "*" else int(part)
+            if uid <= top:
+                uids.add(uid)
+    return sorted(u for u in uids if u >= 1)
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        server = self.server
+        if server.connect_latency:
+            time.sleep(server.connect_latency)
+        self.request = server.ssl_context.wrap_socket(self.request, server_side=True)
+        self.write_lock = threading.Lock()
+        self.mailbox = None
+        super().setup()
+
+    def send(self, data):
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def untagged(self, line):
+        try:
+            self.send(line.encode() + b"\r\n")
+        except OSError:
+            pass
+
+    def reply(self, tag, text="OK completed", *untagged):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        out = b"".join(u if isinstance(u, bytes) else u.encode() + b"\r\n" for u in untagged)
+        self.send(out + tag + b" " + text.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.stats.add("connections")
+        self.untagged(f"* OK [CAPABILITY {CAPABILITIES}] fake imap ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            m = _LINE_RE.match(line.rstrip(b"\r\n"))
+            if not m:
+                continue
+            tag, command, args = m.group(1), m.group(2).decode().upper(), (m.group(3) or b"").decode()
+            uid = False
+            if command == "UID":
+                uid = True
+                command, _, args = args.partition(" ")
+                command = command.upper()
+            self.server.stats.add(command)
+            handler = getattr(self, "cmd_" + command.lower(), None)
+            if handler is None:
+                self.reply(tag, "BAD unknown command")
+                continue
+            try:
+                if handler(tag, args, uid) is False:
+                    return
+            except (ValueError, IndexError) as e:
+                self.reply(tag, f"BAD {e}")
+
+    def cmd_capability(self, tag, args, uid):
+        self.reply(tag, "OK CAPABILITY completed", f"* CAPABILITY {CAPABILITIES}")
+
+    def cmd_noop(self, tag, args, uid):
+        self.reply(tag)
+
+    def cmd_logout(self, tag, args, uid):
+        self.reply(tag, "OK LOGOUT completed", "* BYE logging out")
+        return False
+
+    def cmd_authenticate(self, tag, args, uid):
+        self.send(b"+ \r\n")
+        payload = base64.b64decode(self.rfile.readline().strip() or b"")
+        fields = dict(p.split("=", 1) for p in payload.decode().split("\x01") if "=" in p)
+        token = fields.get("auth", "").replace("Bearer ", "", 1)
+        if not token or token.startswith("expired"):
+            self.server.stats.add("auth_failed")
+            self.reply(tag, "NO [AUTHENTICATIONFAILED] Invalid credentials")
+            return
+        self.mailbox = self.server.mailbox(fields.get("user", ""))
+        self.reply(tag, "OK authenticated")
+
+    def cmd_select(self, tag, args, uid):
+        box = self.mailbox
+        if box is None:
+            self.reply(tag, "NO not authenticated")
+            return
+        with box.lock:
+            self.reply(
+                tag, "OK [READ-WRITE] SELECT completed",
+                "* FLAGS (\\Seen \\Answered \\Flagged \\Deleted \\Draft)",
+                f"* {box.exists()} EXISTS",
+                "* 0 RECENT",
+                f"* OK [UIDVALIDITY {box.uidvalidity}] UIDs valid",
+                f"* OK [UIDNEXT {box.uidnext}] Predicted next UID",
+                f"* OK [HIGHESTMODSEQ {box.modseq}] Highest",
+            )
+
+    def cmd_search(self, tag, args, uid):
+        box = self.mailbox
+        tokens = args.split()
+        if tokens and tokens[0].upper() == "CHARSET":
+            tokens = tokens[2:]
+        with box.lock:
+            result = set(range(1, box.uidnext))
+            i = 0
+            while i < len(tokens):
+                key = tokens[i].upper()
+                if key == "UNSEEN":
+                    result &= box.unseen
+                elif key == "SEEN":
+                    result -= box.unseen
+                elif key == "UID":
+                    i += 1
+                    result &= set(parse_set(tokens[i], box.uidnext - 1))
+                elif key != "ALL":
+                    raise ValueError(f"unsupported search key {key}")
+                i += 1
+        self.reply(tag, "OK SEARCH completed", "* SEARCH " + " ".join(map(str, sorted(result))))
+
+    def cmd_fetch(self, tag, args, uid):
+        box = self.mailbox
+        spec, _, items = args.partition(" ")
+        m = _FIELDS_RE.search(items)
+        fields = [f.upper() for f in m.group(1).split()] if m else ["FROM", "SUBJECT", "MESSAGE-ID", "DATE"]
+        section = f"HEADER.FIELDS ({' '.join(fields)})" if m else ""
+        out = []
+        with box.lock:
+            for u in parse_set(spec, box.uidnext - 1):
+                data = box.header(u, fields)
+                out.append(f"* {u} FETCH (UID {u} BODY[{section}] {{{len(data)}}}\r\n".encode() + data + b")\r\n")
+                if "PEEK" not in items.upper():
+                    box.unseen.discard(u)
+        self.server.stats.add("fetched", len(out))
+        self.reply(tag, "OK FETCH completed", *out)
+
+    def cmd_store(self, tag, args, uid):
+        box = self.mailbox
+        spec, op, flags = args.split(" ", 2)
+        out = []
+        with box.lock:
+            for u in parse_set(spec, box.uidnext - 1):
+                if "\\SEEN" in flags.upper():
+                    if op.upper().startswith("+"):
+                        box.unseen.discard(u)
+                    elif op.upper().startswith("-"):
+                        box.unseen.add(u)
+                if ".SILENT" not in op.upper():
+                    seen = "\\Seen" if u not in box.unseen else ""
+                    out.append(f"* {u} FETCH (UID {u} FLAGS ({seen}))")
+            box.modseq += 1
+        self.reply(tag, "OK STORE completed", *out)
+
+    def cmd_idle(self, tag, args, uid):
+        box = self.mailbox
+        self.send(b"+ idling\r\n")
+        with box.lock:
+            box.watchers.add(self)
+        try:
+            line = self.rfile.readline()
+        finally:
+            with box.lock:
+                box.watchers.discard(self)
+        if not line:
+            return False
+        self.reply(tag, "OK IDLE terminated")
+
+
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + n
+            return self.counts[key]
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            counts = dict(self.counts)
+            if reset:
+                self.counts.clear()
+        return counts
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, certfile, keyfile, mailbox_size=50, unread=3, latency=0.0, connect_latency=0.0):
+        super().__init__(address, ImapHandler)
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.mailbox_size = mailbox_size
+        self.unread = unread
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.stats = Stats()
+        self._mailboxes = {}
+        self._lock = threading.Lock()
+
+    def mailbox(self, email_address):
+        with self._lock:
+            box = self._mailboxes.get(email_address)
+            if box is None:
+                box = self._mailboxes[email_address] = Mailbox(email_address, self.mailbox_size, self.unread)
+            return box
+
+    def deliver(self, n):
+        # 全メールボックスに n 通ずつ新着を追加する（IDLE 中の接続には EXISTS を送る）
+        with self._lock:
+            boxes = list(self._mailboxes.values())
+        for box in boxes:
+            box.deliver(n)
+        return len(boxes)
@@ -0,0 +1,51 @@
+import json
+import random
+import argparse
+
+
+# ベンチマーク用の users.json を作る（app.py の旧形式。起動時に users.db へ移行される）
+
+
+def generate_users(count, imap_port, imap_server="127.0.0.1", expired_ratio=0.0, revoked_ratio=0.0, seed=0):
+    rng = random.Random(seed)
+    users = []
+    for i in range(count):
+        roll = rng.random()
+        revoked = roll < revoked_ratio
+        expired = revoked or roll < revoked_ratio + expired_ratio
+        users.append({
+            "LINE_USER_ID": f"U{i:032x}",
+            "state": f"bench-state-{i}",
+            "EMAIL_ADDRESS": f"user{i}@bench.example.com",
+            "IMAP_SERVER": imap_server,
+            "IMAP_PORT": imap_port,
+            # expired で始まるトークンは偽 IMAP サーバーが認証失敗にする（リフレッシュの経路を通す）
+            "access_token": f"expired-{i}" if expired else f"valid-{i}",
+            # revoked で始まるリフレッシュトークンは偽トークンエンドポイントが invalid_grant にする
+            "refresh_token": f"revoked-{i}" if revoked else f"refresh-{i}",
+            "token_expiry": "2099-01-01T00:00:00",
+        })
+    return users
+
+
+def main():
+    p = argparse.ArgumentParser(description="ベンチマーク用の users.json を作る")
+    p.add_argument("count", type=int, help="ユーザー数（100〜50000 程度）")
+    p.add_argument("--imap-port", type=int, required=True)
+    p.add_argument("--imap-server", default="127.0.0.1")
+    p.add_argument("--expired-ratio", type=float, default=0.0, help="アクセストークンが失効しているユーザーの割合")
+    p.add_argument("--revoked-ratio", type=float, default=0.0, help="リフレッシュトークンが失効しているユーザーの割合")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("-o", "--output", default="users.json")
+    args = p.parse_args()
+
+    users = generate_users(
+        args.count, args.imap_port, args.imap_server, args.expired_ratio, args.revoked_ratio, args.seed
+    )
+    with open(args.output, "w") as f:
+        json.dump(users, f, indent=2, ensure_ascii=False)
+    print(f"✅ {len(users)} 人分のユーザーを {args.output} に書き出しました")
+
+
+if __name__ == "__main__":
+    main()
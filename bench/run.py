@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from collections import Counter
+from gen_users import generate_users
+from servers import add_arguments
+
+
+# メールチェックの負荷ベンチマーク。
+# ローカルの偽 IMAP / OAuth / LINE サーバーを別プロセスで起動し、合成したユーザーで engine.poll_once() を回して
+# 周回時間・スループット・ユーザーごとの処理時間（p50/p99）・ピークメモリを測る。
+#
+#   python bench/run.py --users 1000 --cycles 3 --new-mail 1
+#   python bench/run.py --users 50000 --cycles 1 --imap-latency 0.02 --json result.json
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def peak_rss_mb():
+    # Linux の ru_maxrss は KB 単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def start_servers(args):
+    cmd = [
+        sys.executable, os.path.join(BENCH_DIR, "servers.py"),
+        "--mailbox-size", str(args.mailbox_size), "--unread", str(args.unread),
+        "--imap-latency", str(args.imap_latency), "--connect-latency", str(args.connect_latency),
+        "--http-latency", str(args.http_latency), "--push-429-ratio", str(args.push_429_ratio),
+    ]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    ports = json.loads(proc.stdout.readline())
+    return proc, ports
+
+
+def bench_request(http_port, path, method="GET"):
+    req = urllib.request.Request(f"http://127.0.0.1:{http_port}{path}", method=method, data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(req, timeout=30) as res:
+        return json.loads(res.read())
+
+
+def main():
+    p = argparse.ArgumentParser(description="メールチェックの負荷ベンチマーク")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--cycles", type=int, default=3)
+    p.add_argument("--new-mail", type=int, default=1, help="2周目以降、周回の前に各メールボックスへ追加する新着数")
+    p.add_argument("--expired-ratio", type=float, default=0.0, help="アクセストークンが失効しているユーザーの割合")
+    p.add_argument("--revoked-ratio", type=float, default=0.0, help="リフレッシュトークンが失効しているユーザーの割合")
+    p.add_argument("--concurrency", type=int, help="POLL_CONCURRENCY")
+    p.add_argument("--host-limit", type=int, help="IMAP_HOST_LIMIT")
+    p.add_argument("--warm-pool", type=int, help="IMAP_WARM_POOL_SIZE")
+    p.add_argument("--digest-window", type=int, help="DIGEST_WINDOW（まとめ通知の時間・秒）")
+    p.add_argument("--digest-max", type=int, help="DIGEST_MAX_MAILS")
+    p.add_argument("--drain-timeout", type=float, default=120, help="通知キューが空になるまで待つ最大秒数")
+    p.add_argument("--json", help="結果を JSON で書き出すファイル")
+    p.add_argument("--keep", action="store_true", help="作業ディレクトリ（persistent/ とログ）を残す")
+    add_arguments(p)
+    args = p.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    proc, ports = start_servers(args)
+    workdir = tempfile.mkdtemp(prefix="merutsuuchi-bench-")
+    os.makedirs(os.path.join(workdir, "persistent"))
+    with open(os.path.join(workdir, "persistent", "users.json"), "w") as f:
+        json.dump(generate_users(
+            args.users, ports["imap_port"], expired_ratio=args.expired_ratio, revoked_ratio=args.revoked_ratio
+        ), f)
+
+    base_url = f"http://127.0.0.1:{ports['http_port']}"
+    os.environ.update({
+        "IMAP_TLS_VERIFY": "0",
+        "POLL_START_SPREAD": "0",
+        "GOOGLE_TOKEN_URL": base_url + "/token",
+        "LINE_API_ENDPOINT": base_url,
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench",
+        "LINE_CHANNEL_SECRET": "bench",
+        "CLIENT_ID": "bench",
+        "CLIENT_SECRET": "bench",
+    })
+    if args.concurrency:
+        os.environ["POLL_CONCURRENCY"] = str(args.concurrency)
+    if args.host_limit:
+        os.environ["IMAP_HOST_LIMIT"] = str(args.host_limit)
+    if args.warm_pool is not None:
+        os.environ["IMAP_WARM_POOL_SIZE"] = str(args.warm_pool)
+    if args.digest_window is not None:
+        os.environ["DIGEST_WINDOW"] = str(args.digest_window)
+    if args.digest_max is not None:
+        os.environ["DIGEST_MAX_MAILS"] = str(args.digest_max)
+
+    # アプリのログは作業ディレクトリのファイルへ流す（ユーザー数が多いと端末への出力が律速になるため）
+    log_path = os.path.join(workdir, "app.log")
+    real_stdout = sys.stdout
+    sys.stdout = open(log_path, "w", buffering=1 << 16)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    started = time.perf_counter()
+    import engine
+    import metrics
+    engine.start()
+    startup = time.perf_counter() - started
+
+    timings = []
+    outcomes = Counter()
+    lock = threading.Lock()
+    check_email = engine.check_email
+
+    def timed_check_email(user, counts):
+        t0 = time.perf_counter()
+        outcome = "exception"
+        try:
+            outcome, new_mail = check_email(user, counts)
+        finally:
+            elapsed = time.perf_counter() - t0
+            with lock:
+                timings.append(elapsed)
+                outcomes[outcome] += 1
+        return outcome, new_mail
+
+    engine.check_email = timed_check_email
+
+    results = []
+    try:
+        for cycle in range(1, args.cycles + 1):
+            if cycle > 1 and args.new_mail:
+                bench_request(ports["http_port"], f"/_bench/deliver?n={args.new_mail}", "POST")
+            bench_request(ports["http_port"], "/_bench/stats?reset=1")
+            timings.clear()
+            outcomes.clear()
+
+            t0 = time.perf_counter()
+            engine.poll_once(force=True, idle=False)
+            cycle_time = time.perf_counter() - t0
+
+            # 送信キューが空になるまでを別に測る
+            t1 = time.perf_counter()
+            while engine.delivery.pending() and time.perf_counter() - t1 < args.drain_timeout:
+                time.sleep(0.05)
+            drain_time = time.perf_counter() - t1
+
+            server_stats = bench_request(ports["http_port"], "/_bench/stats")
+            result = {
+                "cycle": cycle,
+                "users": len(timings),
+                "cycle_seconds": round(cycle_time, 3),
+                "users_per_second": round(len(timings) / cycle_time, 1) if cycle_time else 0,
+                "p50_ms": round(percentile(timings, 50) * 1000, 1),
+                "p99_ms": round(percentile(timings, 99) * 1000, 1),
+                "max_ms": round(max(timings, default=0) * 1000, 1),
+                "drain_seconds": round(drain_time, 3),
+                "undelivered": engine.delivery.pending(),
+                "outcomes": dict(outcomes),
+                "server": server_stats,
+                "peak_rss_mb": round(peak_rss_mb(), 1),
+            }
+            results.append(result)
+            print(
+                f"cycle {cycle}: {result['users']} users in {result['cycle_seconds']}s "
+                f"({result['users_per_second']}/s) p50={result['p50_ms']}ms p99={result['p99_ms']}ms "
+                f"drain={result['drain_seconds']}s rss={result['peak_rss_mb']}MB {result['outcomes']}",
+                file=real_stdout, flush=True,
+            )
+    finally:
+        proc.stdin.close()
+        proc.wait(timeout=10)
+        sys.stdout.flush()
+        sys.stdout = real_stdout
+
+    summary = {
+        "users": args.users,
+        "cycles": args.cycles,
+        "startup_seconds": round(startup, 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "args": vars(args),
+        "results": results,
+        # アプリ側の段階別の集計（/metrics と同じ内容）
+        "metrics": metrics.render(),
+    }
+    print(f"startup={summary['startup_seconds']}s peak_rss={summary['peak_rss_mb']}MB")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+    if args.keep:
+        print(f"作業ディレクトリ: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    # アプリのスレッド（通知キューなど）は止められないのでそのまま終了する
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import threading
+import subprocess
+from fake_imap import FakeImapServer
+from fake_http import FakeHttpServer
+
+
+# ベンチマーク用の IMAP / HTTP サーバーを1プロセスで起動し、ポートを JSON で標準出力に書く。
+# アプリと同じプロセスで動かすと GIL を取り合って計測がぶれるので、run.py からは別プロセスで起動する
+
+
+def make_cert(directory):
+    # 自己署名証明書。アプリは既定で証明書を検証するので、run.py は IMAP_TLS_VERIFY=0 で起動する
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    if not os.path.exists(certfile):
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30",
+             "-subj", "/CN=127.0.0.1", "-keyout", keyfile, "-out", certfile],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    return certfile, keyfile
+
+
+def add_arguments(p):
+    p.add_argument("--mailbox-size", type=int, default=50, help="初期のメール数")
+    p.add_argument("--unread", type=int, default=3, help="初期の未読メール数")
+    p.add_argument("--imap-latency", type=float, default=0.0, help="IMAP コマンドごとの遅延（秒）")
+    p.add_argument("--connect-latency", type=float, default=0.0, help="IMAP 接続時の遅延（秒）")
+    p.add_argument("--http-latency", type=float, default=0.0, help="トークン更新・push API の遅延（秒）")
+    p.add_argument("--push-429-ratio", type=float, default=0.0, help="push API が 429 を返す割合")
+
+
+def main():
+    p = argparse.ArgumentParser(description="ベンチマーク用の IMAP / OAuth / LINE サーバー")
+    add_arguments(p)
+    p.add_argument("--cert-dir", default=tempfile.gettempdir())
+    args = p.parse_args()
+
+    certfile, keyfile = make_cert(args.cert_dir)
+    imap = FakeImapServer(
+        ("127.0.0.1", 0), certfile, keyfile,
+        mailbox_size=args.mailbox_size, unread=args.unread,
+        latency=args.imap_latency, connect_latency=args.connect_latency,
+    )
+    http = FakeHttpServer(("127.0.0.1", 0), imap=imap, latency=args.http_latency, push_429_ratio=args.push_429_ratio)
+    threading.Thread(target=imap.serve_forever, daemon=True).start()
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    print(json.dumps({"imap_port": imap.server_address[1], "http_port": http.server_address[1]}), flush=True)
+    # 親プロセスが標準入力を閉じたら終了する
+    sys.stdin.read()
+
+
+if __name__ == "__main__":
+    main()
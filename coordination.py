@@ -0,0 +1,162 @@
+import os
+import time
+import bisect
+import fcntl
+import socket
+import hashlib
+import sqlite3
+import threading
+
+
+# none : 分担しない（プロセスが1つの場合）
+# leader: ロックファイルを取れた1プロセスだけがメールチェックする（同一ホストの gunicorn ワーカー向け）
+# shard : 生きているメンバーで LINE_USER_ID をコンシステントハッシュで分担する（複数ワーカー・複数ノード向け）
+POLL_PARTITION = os.environ.get("POLL_PARTITION", "none")
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEADER_LOCK_FILE = "./persistent/poller.lock"
+# shard モードのメンバー表。複数ノードでは共有ボリューム上のパスを指定する
+COORDINATION_DB = os.environ.get("COORDINATION_DB", "./persistent/coordination.db")
+HEARTBEAT_INTERVAL = 10
+MEMBER_TTL = 45
+VNODES = 64
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+
+    def __init__(self, members, vnodes=VNODES):
+        points = sorted((_hash(f"{m}#{i}"), m) for m in members for i in range(vnodes))
+        self._keys = [p[0] for p in points]
+        self._members = [p[1] for p in points]
+
+    def owner(self, key):
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._members[i]
+
+
+class Coordinator:
+    # どのユーザーをこのプロセスがチェックするかを決める。
+    # 担当が変わったら on_rebalance() を呼ぶ（通知回数の読み直しなど）
+
+    def __init__(self, mode=POLL_PARTITION, worker_id=WORKER_ID, on_rebalance=None):
+        if mode not in ("none", "leader", "shard"):
+            raise ValueError(f"POLL_PARTITION が不正です: {mode}")
+        self.mode = mode
+        self.worker_id = worker_id
+        self.on_rebalance = on_rebalance
+        self._lock = threading.Lock()
+        self._leader_file = None
+        self._members = ()
+        self._ring = None
+        self._started = False
+
+    def start(self):
+        if self._started or self.mode != "shard":
+            return
+        self._started = True
+        self._heartbeat()
+        threading.Thread(target=self._heartbeat_loop, name="coordination", daemon=True).start()
+
+    # --- leader モード ---
+
+    def _try_lead(self):
+        if self._leader_file is not None:
+            return True
+        directory = os.path.dirname(LEADER_LOCK_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        f = open(LEADER_LOCK_FILE, "a+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        # ロックはプロセス終了時にOSが解放するので、残ったワーカーが引き継げる
+        self._leader_file = f
+        print(f"👑 {self.worker_id} がメールチェックの担当になりました")
+        if self.on_rebalance:
+            self.on_rebalance()
+        return True
+
+    # --- shard モード ---
+
+    def _conn(self):
+        directory = os.path.dirname(COORDINATION_DB)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(COORDINATION_DB, timeout=30, isolation_level=None)
+        conn.execute("CREATE TABLE IF NOT EXISTS members (worker_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)")
+        return conn
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self._heartbeat()
+            except sqlite3.Error as e:
+                print(f"⚠️ ハートビート失敗: {e}")
+
+    def _heartbeat(self):
+        now = time.time()
+        conn = self._conn()
+        try:
+            conn.execute(
+                "INSERT INTO members (worker_id, last_seen) VALUES (?, ?) "
+                "ON CONFLICT(worker_id) DO UPDATE SET last_seen = excluded.last_seen",
+                (self.worker_id, now),
+            )
+            conn.execute("DELETE FROM members WHERE last_seen < ?", (now - MEMBER_TTL * 10,))
+            members = tuple(sorted(
+                row[0] for row in conn.execute("SELECT worker_id FROM members WHERE last_seen >= ?", (now - MEMBER_TTL,))
+            ))
+        finally:
+            conn.close()
+
+        with self._lock:
+            if members != self._members:
+                # メンバーが変わった直後（起動直後を含む）は、他のメンバーも同じ表を見るまで何も担当しない。
+                # 同時に起動したワーカーが自分だけの表で全員を担当し、二重にチェックするのを防ぐ
+                self._members = members
+                self._ring = None
+                return
+            if self._ring is not None:
+                return
+            # 同じメンバーを HEARTBEAT_INTERVAL あけて2回続けて確認できたので担当を決める
+            self._ring = HashRing(members)
+        print(f"🔀 担当を再分配しました（メンバー {len(members)}）: {', '.join(members)}")
+        if self.on_rebalance:
+            self.on_rebalance()
+
+    # --- 共通 ---
+
+    def settled(self):
+        # 担当が決まっているか（shard モードではメンバーが落ち着くまで False）
+        if self.mode != "shard":
+            return True
+        with self._lock:
+            return self._ring is not None
+
+    def active(self):
+        # このプロセスがメールチェックをするか
+        if self.mode == "leader":
+            return self._try_lead()
+        return True
+
+    def owns(self, line_user_id):
+        if self.mode != "shard":
+            return self.active()
+        with self._lock:
+            ring = self._ring
+        return ring is not None and ring.owner(line_user_id) == self.worker_id
+
+    def owned(self, users):
+        if self.mode == "none":
+            return users
+        if not self.active():
+            return []
+        return [u for u in users if u.get("LINE_USER_ID") and self.owns(u["LINE_USER_ID"])]
@@ -0,0 +1,204 @@
+import os
+import time
+import uuid
+import queue
+import random
+import sqlite3
+import threading
+import requests
+from linebot.exceptions import LineBotApiError
+import metrics
+
+
+OUTBOX_DB = "./persistent/outbox.db"
+DELIVERY_WORKERS = int(os.environ.get("DELIVERY_WORKERS", 4))
+DELIVERY_QUEUE_SIZE = int(os.environ.get("DELIVERY_QUEUE_SIZE", 1000))
+# LINE の push API の上限（2,000 リクエスト/秒）より余裕をもたせる
+LINE_PUSH_RATE = float(os.environ.get("LINE_PUSH_RATE", 1000))
+DELIVERY_MAX_ATTEMPTS = int(os.environ.get("DELIVERY_MAX_ATTEMPTS", 8))
+RETRY_BACKOFF_BASE = 2
+RETRY_BACKOFF_MAX = 600
+# 取り出した通知を他プロセス・再起動後に拾わせないようにしておく時間（秒）
+LEASE_SECONDS = 120
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    line_user_id TEXT NOT NULL,
+    text         TEXT NOT NULL,
+    retry_key    TEXT NOT NULL,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    next_at      REAL NOT NULL,
+    lease_until  REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outbox_next_at ON outbox(next_at);
+"""
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def retry_after(e):
+    # 再送すべきエラーなら待ち秒数（不明なら 0）、再送しないなら None
+    if isinstance(e, LineBotApiError):
+        if e.status_code == 429 or e.status_code >= 500:
+            try:
+                return float((e.headers or {}).get("Retry-After", 0))
+            except ValueError:
+                return 0
+        return None
+    if isinstance(e, (requests.RequestException, OSError)):
+        return 0
+    return None
+
+
+class DeliveryQueue:
+    # LINE への通知を IMAP の処理から切り離して送る。
+    # 通知はまず outbox（SQLite）に書き、ワーカースレッドが送信に成功したら消す
+
+    def __init__(self, send, path=OUTBOX_DB, workers=DELIVERY_WORKERS, rate=LINE_PUSH_RATE):
+        self.send = send
+        self.path = path
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.queue = queue.Queue(maxsize=DELIVERY_QUEUE_SIZE)
+        self._local = threading.local()
+        self._started = False
+        self._start_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"delivery-{i}", daemon=True).start()
+        # 再送待ち・再起動前に残っていた通知を拾う
+        threading.Thread(target=self._sweep, name="delivery-sweeper", daemon=True).start()
+
+    def enqueue(self, line_user_id, text):
+        now = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO outbox (line_user_id, text, retry_key, next_at, lease_until) VALUES (?, ?, ?, ?, ?)",
+            (line_user_id, text, str(uuid.uuid4()), now, now + LEASE_SECONDS),
+        )
+        try:
+            self.queue.put_nowait(cur.lastrowid)
+        except queue.Full:
+            # キューが溢れたら outbox に残し、スイーパーに任せる
+            self._conn().execute("UPDATE outbox SET lease_until = 0 WHERE id = ?", (cur.lastrowid,))
+
+    def pending(self):
+        return self._conn().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def _sweep(self):
+        while True:
+            try:
+                self._claim_due()
+            except sqlite3.Error as e:
+                print(f"⚠️ 通知キューの再送処理でエラー: {e}")
+            time.sleep(1)
+
+    def _claim_due(self):
+        room = DELIVERY_QUEUE_SIZE - self.queue.qsize()
+        if room <= 0:
+            return
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ids = [row[0] for row in conn.execute(
+                "SELECT id FROM outbox WHERE next_at <= ? AND lease_until < ? ORDER BY next_at LIMIT ?",
+                (now, now, room),
+            )]
+            conn.executemany(
+                "UPDATE outbox SET lease_until = ? WHERE id = ?",
+                [(now + LEASE_SECONDS, i) for i in ids],
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        for i in ids:
+            self.queue.put(i)
+
+    def _work(self):
+        while True:
+            outbox_id = self.queue.get()
+            try:
+                self._deliver(outbox_id)
+            except Exception as e:
+                print(f"❌ 通知送信処理でエラー: {e}")
+            finally:
+                self.queue.task_done()
+
+    def _deliver(self, outbox_id):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT line_user_id, text, retry_key, attempts FROM outbox WHERE id = ?", (outbox_id,)
+        ).fetchone()
+        if row is None:
+            return
+        line_user_id, text, retry_key, attempts = row
+
+        self.bucket.acquire()
+        try:
+            with metrics.timer("phase_seconds", phase="line_push"):
+                self.send(line_user_id, text, retry_key)
+        except Exception as e:
+            if isinstance(e, LineBotApiError) and e.status_code == 409 and e.accepted_request_id:
+                # 同じ retry_key の通知は送信済み
+                conn.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+                metrics.inc("line_pushes_total", result="duplicate")
+                return
+            wait = retry_after(e)
+            attempts += 1
+            if wait is None or attempts >= DELIVERY_MAX_ATTEMPTS:
+                print(f"[{line_user_id}] ❌ メール通知送信失敗（{attempts}回目・破棄）: {e}")
+                conn.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+                metrics.inc("line_pushes_total", result="dropped")
+                return
+            delay = max(wait, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0))
+            print(f"[{line_user_id}] ⚠️ メール通知送信失敗（{attempts}回目・{delay:.0f}秒後に再送）: {e}")
+            conn.execute(
+                "UPDATE outbox SET attempts = ?, next_at = ?, lease_until = 0 WHERE id = ?",
+                (attempts, time.time() + delay, outbox_id),
+            )
+            metrics.inc("line_pushes_total", result="retry")
+            return
+
+        conn.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+        metrics.inc("line_pushes_total", result="sent")
+        print(f"[{line_user_id}] メール通知送信完了")
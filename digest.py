@@ -0,0 +1,35 @@
+import os
+
+
+# まとめ通知。新着メールをすぐに送らずユーザーごとにためておき、
+# DIGEST_WINDOW 秒たつか DIGEST_MAX_MAILS 件たまったら1通にまとめて送る。
+# 緊急扱いの差出人からのメールが来たら、ためていた分と一緒にすぐ送る
+
+# まとめる時間（秒）。0 ならまとめずにすぐ送る。ユーザー情報の digest_window で個別に変えられる
+DIGEST_WINDOW = int(os.environ.get("DIGEST_WINDOW", 0))
+# この件数たまったら時間を待たずに送る
+DIGEST_MAX_MAILS = int(os.environ.get("DIGEST_MAX_MAILS", 10))
+# 緊急扱いの差出人（カンマ区切り。「taro@example.com」はアドレス、「example.com」「@example.com」はドメイン全体）。
+# ユーザー情報の urgent_senders にも同じ形式で追加できる
+DIGEST_URGENT_SENDERS = os.environ.get("DIGEST_URGENT_SENDERS", "")
+
+
+def _rules(value):
+    if isinstance(value, str):
+        value = value.split(",")
+    return [rule.strip().lower() for rule in value or [] if rule.strip()]
+
+
+def window(user):
+    value = user.get("digest_window")
+    return DIGEST_WINDOW if value is None else int(value)
+
+
+def is_urgent(user, address):
+    address = (address or "").strip().lower()
+    if not address:
+        return False
+    for rule in _rules(DIGEST_URGENT_SENDERS) + _rules(user.get("urgent_senders")):
+        if address == rule or address.endswith("@" + rule.lstrip("@")):
+            return True
+    return False
@@ -0,0 +1,577 @@
+import os
+import time
+import datetime
+import threading
+import imaplib
+from linebot import LineBotApi
+from linebot.models import TextSendMessage
+from poller import run_cycle, watchdog, POLL_USER_DEADLINE
+from poll_scheduler import PollScheduler, NEW_MAIL, NO_MAIL, AT_LIMIT, NOT_READY, AUTH_FAILED, CIRCUIT_OPEN, ERROR
+from imap_utils import fetch_headers, mark_seen, get_sync_state, sync_new_uids
+from imap_pool import connector as imap_connector, abort_connection, limit_timeout
+from idle import IdleSessionManager
+from user_store import UserStore
+from delivery import DeliveryQueue
+from notify_counts import NotifyCounter
+from coordination import Coordinator, HEARTBEAT_INTERVAL
+import metrics
+import auth_health
+import digest
+import jobs
+import notification
+from notification import Mail, decode_mime_words, header_text, parse_sender
+from token_manager import TokenManager
+
+
+# メールチェックの本体（IMAP・トークン更新・LINE通知）。
+# Web（app.py）と同じプロセスで APScheduler から回すことも、
+# 専用のワーカー（checker.py）として別プロセスで回すこともできる
+
+LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
+CLIENT_ID = os.environ.get("CLIENT_ID")
+CLIENT_SECRET = os.environ.get("CLIENT_SECRET")
+REDIRECT_URI = os.environ.get("REDIRECT_URI")
+# ベンチマークではローカルのダミーサーバーに向ける（bench/）
+LINE_API_ENDPOINT = os.environ.get("LINE_API_ENDPOINT", "https://api.line.me")
+# LINE API の (接続, 読み込み) タイムアウト（秒）
+LINE_TIMEOUT = (
+    float(os.environ.get("LINE_CONNECT_TIMEOUT", 5)),
+    float(os.environ.get("LINE_READ_TIMEOUT", 10)),
+)
+USERS_FILE = "./persistent/users.json"  # 旧形式（起動時に USERS_DB へ移行）
+USERS_DB = "./persistent/users.db"
+COUNT_FILE = "./persistent/notify_counts.json"
+NOTIFY_LIMIT = 30
+# 1通の通知に差出人・件名を並べるメールの件数（残りは「他 N 件」）
+NOTIFY_MAX_MAILS = 5
+# 通知対象を未読メールに限定するか／通知したメールを既読にするか
+NOTIFY_UNSEEN_ONLY = os.environ.get("NOTIFY_UNSEEN_ONLY", "1") == "1"
+MARK_AS_READ = os.environ.get("MARK_AS_READ", "1") == "1"
+# 1 にすると、ユーザーごとに接続を張りっぱなしにして IMAP IDLE で新着を待つ
+IMAP_IDLE = os.environ.get("IMAP_IDLE", "0") == "1"
+# 期限が来たユーザーを拾う間隔（秒）。ユーザーごとの間隔は poll_scheduler が決める
+POLL_TICK_SECONDS = int(os.environ.get("POLL_TICK_SECONDS", 30))
+# トークンの先行更新・通知回数のスナップショットの間隔（秒）
+TOKEN_REFRESH_INTERVAL = 60
+COUNT_SNAPSHOT_INTERVAL = 5 * 60
+# 1回だけ実行する場合に、通知の送信が終わるまで待つ最大秒数
+DRAIN_TIMEOUT = 60
+# APScheduler に登録するメールチェックのジョブの ID
+POLL_JOB_ID = "poll"
+
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_ENDPOINT, timeout=LINE_TIMEOUT)
+
+# LINE への通知は IMAP の処理とは別スレッドで送る
+delivery = DeliveryQueue(
+    lambda line_user_id, text, retry_key: line_bot_api.push_message(
+        line_user_id, TextSendMessage(text=text), retry_key=retry_key
+    )
+)
+
+user_store = UserStore(USERS_DB)
+user_store.migrate_from_json(USERS_FILE)
+
+# 通知回数（メモリ上で管理し、ジャーナルとスナップショットで永続化）
+notify_counts = NotifyCounter(COUNT_FILE)
+
+# gunicorn の各ワーカー・各ノードでチェックするユーザーを重複させない（POLL_PARTITION）
+coordinator = Coordinator(on_rebalance=notify_counts.reload)
+
+
+def is_user_ready(user):
+    required_keys = ["LINE_USER_ID", "EMAIL_ADDRESS", "access_token", "refresh_token"]
+    for key in required_keys:
+        if not user.get(key):
+            print(f"[{user.get('LINE_USER_ID', '不明')}] ⚠️ 必須キー {key} が未設定のためスキップ")
+            return False
+    return True
+
+def generate_oauth2_string(email_address, access_token):
+    return f"user={email_address}\1auth=Bearer {access_token}\1\1".encode()
+
+def save_refreshed_token(line_user_id, fields):
+    user_store.update(line_user_id, **fields)
+    idle_manager.update_user(line_user_id, fields)
+
+def build_auth_url(state):
+    return (
+        f"https://accounts.google.com/o/oauth2/v2/auth"
+        f"?client_id={CLIENT_ID}"
+        f"&redirect_uri={REDIRECT_URI}"
+        f"&response_type=code"
+        f"&scope=https://mail.google.com/ https://www.googleapis.com/auth/userinfo.email"
+        f"&access_type=offline"
+        f"&prompt=consent"
+        f"&state={state}"
+    )
+
+def save_auth_health(user, fields):
+    if not fields:
+        return
+    line_user_id = user["LINE_USER_ID"]
+    user.update(fields)
+    user_store.update(line_user_id, **fields)
+    idle_manager.update_user(line_user_id, fields)
+    if fields.get("auth_health") == auth_health.OPEN and not user.get("reauth_prompted"):
+        # 再認証のお願いは1回だけ送る（Google 認証をやり直すとリセットされる）
+        print(f"[{line_user_id}] 🔒 認証情報が無効なためチェックを停止し、再認証をお願いします")
+        metrics.inc("auth_circuit_opened_total")
+        message = (
+            "⚠️ 【Google再認証のお願い】\n\n"
+            "Gmailへのアクセス許可が無効になったため、メール通知を停止しています。\n"
+            "下記URLから、通知したいGmailアカウントで再度ログインしてください。\n\n"
+            f"{build_auth_url(user.get('state'))}\n\n"
+            "不明点があればX（旧Twitter）のDMでお問い合わせください。\n"
+            "👉 https://x.com/job_akira"
+        )
+        delivery.enqueue(line_user_id, message)
+        save_auth_health(user, {"reauth_prompted": True})
+
+def record_auth_failure(user, revoked=False):
+    save_auth_health(user, auth_health.failed(user, revoked=revoked))
+
+def on_token_revoked(user):
+    print(f"[{user['LINE_USER_ID']}] リフレッシュトークンが失効しています")
+    record_auth_failure(user, revoked=True)
+
+token_manager = TokenManager(CLIENT_ID, CLIENT_SECRET, save_refreshed_token, on_token_revoked)
+
+def skip_reason(user, counts):
+    if not is_user_ready(user):
+        return NOT_READY
+    if auth_health.blocked(user):
+        # 認証が通らないユーザーは再認証（またはバックオフ明け）まで通信しない
+        return CIRCUIT_OPEN
+
+    line_user_id = user["LINE_USER_ID"]
+    if counts.get(line_user_id, 0) >= NOTIFY_LIMIT:
+        print(f"[{line_user_id}] ⚠️ 通知上限（{NOTIFY_LIMIT}回）に達しています。通知をスキップします。")
+        return AT_LIMIT
+    return None
+
+def should_check(user, counts):
+    return skip_reason(user, counts) is None
+
+
+class AuthenticationFailed(imaplib.IMAP4.error):
+    # AUTHENTICATE が NO [AUTHENTICATIONFAILED] で拒否された（トークンが無効）。
+    # 接続断（IMAP4.abort）・混雑（[THROTTLED] など）・SELECT の失敗はこれに含めない
+    pass
+
+
+def open_imap(imap_server, imap_port, email_address, access_token, deadline=None):
+    # 接続（TCP + TLS、待機中の接続があれば再利用）・XOAUTH2 認証・SELECT の各段階の時間を記録する。
+    # deadline（time.monotonic() 基準）を渡すと、各段階のタイムアウトをその残り時間以下にする
+    def login(mail):
+        with metrics.timer("phase_seconds", phase="auth"):
+            try:
+                mail.authenticate("XOAUTH2", lambda x: generate_oauth2_string(email_address, access_token))
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as e:
+                if "AUTHENTICATIONFAILED" in str(e).upper():
+                    raise AuthenticationFailed(str(e)) from e
+                raise
+
+    mail = imap_connector.connect(imap_server, imap_port, login, deadline)
+    try:
+        limit_timeout(mail, deadline)
+        with metrics.timer("phase_seconds", phase="select"):
+            mail.select("inbox")
+    except BaseException:
+        mail.shutdown()
+        raise
+    return mail
+
+
+def connect_imap(user, deadline=None):
+    # deadline を過ぎると TimeoutError（トークン更新・接続・認証のどの段階でも）。
+    # 認証の失敗として数えるのは AuthenticationFailed だけで、それ以外の IMAP のエラーはそのまま送出する
+    # （呼び出し元で一時的なエラーとして扱う）
+    line_user_id = user["LINE_USER_ID"]
+    email_address = user["EMAIL_ADDRESS"]
+    if token_manager.needs_refresh(user):
+        # 期限切れ間近のトークンは接続前に更新しておく（失敗時は今のトークンで試す）
+        token_manager.refresh(user, deadline)
+        if auth_health.blocked(user):
+            return None
+    access_token = user["access_token"]
+    imap_server = user.get("IMAP_SERVER", "imap.gmail.com")
+    imap_port = user.get("IMAP_PORT", 993)
+
+    try:
+        mail = open_imap(imap_server, imap_port, email_address, access_token, deadline)
+    except AuthenticationFailed:
+        print(f"[{line_user_id}] IMAP認証失敗。リフレッシュを試みます")
+        metrics.inc("imap_auth_failures_total")
+        new_token = token_manager.refresh(user, deadline)
+        if new_token:
+            user["access_token"] = new_token
+            try:
+                mail = open_imap(imap_server, imap_port, email_address, new_token, deadline)
+            except AuthenticationFailed as e2:
+                print(f"[{line_user_id}] リフレッシュ後も認証失敗:", e2)
+                record_auth_failure(user)
+                return None
+        else:
+            # 失効していた場合は on_token_revoked で記録済み。通信エラーなどは数えない
+            return None
+    save_auth_health(user, auth_health.succeeded(user))
+    return mail
+
+
+def check_email(user, counts):
+    # 戻り値: (チェック結果, 新着件数)
+    reason = skip_reason(user, counts)
+    if reason:
+        return reason, 0
+
+    # トークン更新・接続・認証を含めて POLL_USER_DEADLINE 秒で打ち切る。
+    # 接続までは各段階のタイムアウトを残り時間以下にし、接続後は watchdog で接続を切る
+    deadline = time.monotonic() + POLL_USER_DEADLINE
+    try:
+        mail = connect_imap(user, deadline)
+    except TimeoutError:
+        if time.monotonic() < deadline:
+            raise
+        deadline_exceeded(user)
+        return ERROR, 0
+    except imaplib.IMAP4.error as e:
+        # 接続断・混雑・SELECT の失敗などは認証失敗とは数えず、エラーとしてバックオフさせる
+        if time.monotonic() >= deadline:
+            deadline_exceeded(user)
+        else:
+            print(f"[{user['LINE_USER_ID']}] ⚠️ IMAP接続エラー: {e}")
+        metrics.inc("imap_connect_errors_total")
+        return ERROR, 0
+    if mail is None:
+        return AUTH_FAILED, 0
+    timed_out = threading.Event()
+
+    def abort():
+        timed_out.set()
+        abort_connection(mail)
+
+    cancel = watchdog.watch(max(0, deadline - time.monotonic()), abort)
+    try:
+        new_mail = check_mailbox(mail, user, counts)
+    except (imaplib.IMAP4.abort, OSError):
+        if not timed_out.is_set():
+            raise
+        deadline_exceeded(user)
+        new_mail = None
+    finally:
+        cancel.set()
+        if timed_out.is_set():
+            mail.shutdown()
+        else:
+            mail.logout()
+    if new_mail is None:
+        return ERROR, 0
+    return (NEW_MAIL if new_mail else NO_MAIL), new_mail
+
+
+def deadline_exceeded(user):
+    print(f"[{user['LINE_USER_ID']}] ⏱️ チェックが {POLL_USER_DEADLINE:.0f}秒を超えたため中断しました")
+    metrics.inc("poll_deadline_exceeded_total")
+
+
+def check_mailbox(mail, user, counts):
+    line_user_id = user["LINE_USER_ID"]
+
+    email_ids, sync_state = sync_new_uids(mail, get_sync_state(user), NOTIFY_UNSEEN_ONLY)
+    if email_ids is None:
+        print(f"[{line_user_id}] メール検索失敗")
+        return None
+
+    if not email_ids:
+        print(f"[{line_user_id}] 未読メールなし")
+        save_sync_state(user, sync_state)
+        return 0
+
+    # 通知済みのメール（既読化の失敗・未読に戻されたもの・他プロセスが通知したもの）は除く。
+    # まず UID で除き、取得したヘッダーの Message-ID でもう一度除く
+    uid_keys = {num: f"uid:{sync_state['uidvalidity']}:{num}" for num in email_ids}
+    notified = user_store.notified(line_user_id, uid_keys.values())
+    fresh = [num for num in email_ids if uid_keys[num] not in notified]
+
+    # 表示する NOTIFY_MAX_MAILS 件が揃うまで、足りない分だけヘッダーを取得しては Message-ID で除く。
+    # ヘッダーを取得していないメール・取得できなかったメールは「他 N 件」に数える
+    headers, message_keys, duplicates = {}, {}, set()
+    pending = fresh
+    while pending and len(headers) < NOTIFY_MAX_MAILS:
+        batch, pending = pending[:NOTIFY_MAX_MAILS - len(headers)], pending[NOTIFY_MAX_MAILS - len(headers):]
+        fetched = fetch_headers(mail, batch)
+        if not fetched:
+            break  # FETCH が失敗している。残りは「他 N 件」に数える
+        keys = {
+            num: f"mid:{header_text(msg['Message-ID']).strip()}" for num, msg in fetched.items() if msg.get("Message-ID")
+        }
+        notified = user_store.notified(line_user_id, keys.values())
+        for num in batch:
+            if num in keys and keys[num] in notified:
+                duplicates.add(num)
+            elif num in fetched:
+                headers[num] = fetched[num]
+                if num in keys:
+                    message_keys[num] = keys[num]
+    fresh = [num for num in fresh if num not in duplicates]
+
+    if not fresh:
+        print(f"[{line_user_id}] 通知済みのメールのみのためスキップ（{len(email_ids)}件）")
+        if MARK_AS_READ:
+            mark_seen(mail, email_ids)
+        if duplicates:
+            user_store.remember_notified(line_user_id, [uid_keys[num] for num in duplicates])
+        save_sync_state(user, sync_state)
+        return 0
+
+    mails = []
+    urgent = False
+    for num in fresh:
+        msg = headers.get(num)
+        if msg is None:
+            continue
+        sender, address = parse_sender(msg.get("From", "不明"))
+        mails.append(Mail(sender, decode_mime_words(msg["Subject"])))
+        urgent = urgent or digest.is_urgent(user, address)
+
+    others = len(fresh) - len(mails)
+
+    if MARK_AS_READ:
+        mark_seen(mail, email_ids)
+        print("✅ 未読メールを既読にしました。")
+        
+
+    notify(user, mails, others, counts, urgent)
+    # 今回通知した（一覧か「他 N 件」に含めた）メールと、Message-ID で通知済みとわかったメールの UID を記録する
+    user_store.remember_notified(
+        line_user_id,
+        [uid_keys[num] for num in fresh + sorted(duplicates)]
+        + [message_keys[num] for num in fresh if num in message_keys],
+    )
+    save_sync_state(user, sync_state)
+    return len(fresh)
+
+
+def notify(user, mails, others, counts, urgent=False):
+    # まとめ通知が有効なら、緊急の差出人でない限りためておく（digest.py）
+    line_user_id = user["LINE_USER_ID"]
+    window = digest.window(user)
+    if window > 0 and not urgent:
+        buffered = user_store.buffer_digest(line_user_id, mails, others, time.time() + window)
+        if buffered < digest.DIGEST_MAX_MAILS:
+            print(f"[{line_user_id}] 📥 まとめ通知にためました（{buffered}件）")
+            metrics.inc("notifications_total", result="buffered")
+            return
+        mails, others = None, 0
+    send_notification(line_user_id, mails, others, counts)
+
+def send_notification(line_user_id, mails, others, counts):
+    # ためていたメールがあれば、古い順に先頭へまとめて1通で送る。
+    # mails が None なら、ためていた分だけを送る（なければ何もしない）
+    buffered, buffered_others = user_store.take_digest(line_user_id)
+    if mails is None and not buffered and not buffered_others:
+        return
+    mails = [Mail(*mail) for mail in buffered] + (mails or [])
+    others += buffered_others
+    shown = max(NOTIFY_MAX_MAILS, digest.DIGEST_MAX_MAILS) if buffered else NOTIFY_MAX_MAILS
+    others += max(0, len(mails) - shown)
+    mails = mails[:shown]
+
+    notify_count = counts.increment(line_user_id)
+    message = notification.render(mails, others, notify_count, NOTIFY_LIMIT)
+    delivery.enqueue(line_user_id, message)
+    print(f"[{line_user_id}] メール通知を送信キューに追加")
+    metrics.inc("notifications_total", result="digest" if buffered else "sent")
+
+def flush_digests(users, counts):
+    # まとめる時間が過ぎたユーザーの分を送る（担当しているユーザーのみ）
+    owned = {u.get("LINE_USER_ID") for u in users}
+    for line_user_id in user_store.digest_due():
+        if line_user_id in owned:
+            send_notification(line_user_id, None, 0, counts)
+
+
+def save_sync_state(user, sync_state):
+    if all(user.get(key) == value for key, value in sync_state.items()):
+        return
+    user.update(sync_state)
+    user_store.update(user["LINE_USER_ID"], **sync_state)
+
+def load_users():
+    return user_store.all()
+
+
+idle_manager = IdleSessionManager(connect_imap, check_mailbox, should_check)
+poll_scheduler = PollScheduler()
+# メールチェックの周回が重ならないようにするロック
+cycle_lock = threading.Lock()
+# 起動後、担当ユーザー全員を一度チェックし終えたら立てる（/ready）
+poller_ready = threading.Event()
+
+def poll_user(user, counts, report=None):
+    line_user_id = user["LINE_USER_ID"]
+    outcome, new_mail = ERROR, 0
+    started = time.monotonic()
+    try:
+        outcome, new_mail = check_email(user, counts)
+    finally:
+        poll_scheduler.record(line_user_id, outcome, new_mail)
+        metrics.inc("poll_checks_total", outcome=outcome)
+        if report:
+            report.record(line_user_id, outcome, new_mail, time.monotonic() - started)
+
+def run_jobs(users, counts):
+    # 管理用 API で受け付けたジョブ（jobs.py）のうち、このプロセスの担当ユーザーの分をチェックする
+    by_id = {u.get("LINE_USER_ID"): u for u in users if u.get("LINE_USER_ID")}
+    for job_id, pending in jobs.pending(user_store):
+        claimed = user_store.claim_job_users(job_id, [uid for uid in pending if uid in by_id], coordinator.worker_id)
+        if not claimed:
+            continue
+        poll_scheduler.sync(by_id)
+        due = poll_scheduler.pop(claimed)
+        print(f"🛠️ ジョブ {job_id}: {len(due)}人をチェックします")
+        report = jobs.JobReport(user_store, job_id)
+        skipped = run_cycle([by_id[uid] for uid in due], lambda user: poll_user(user, counts, report))
+        skipped = [u["LINE_USER_ID"] for u in skipped]
+        poll_scheduler.release(skipped)
+        user_store.release_job_users(job_id, skipped + [uid for uid in claimed if uid not in due])
+
+def poll_once(force=False, idle=IMAP_IDLE):
+    # 1周分のチェック。force=True なら次回時刻に関係なく全員をチェックする。
+    # 前回の周回が実行中ならスキップして False を返す
+    if not cycle_lock.acquire(blocking=False):
+        print("⚠️ 前回のメールチェックが実行中のためスキップします")
+        return False
+    try:
+        if not coordinator.settled():
+            # 担当の分担が決まるまでは誰もチェックしない（担当の重複による二重通知を防ぐ）
+            print("⏳ 担当の分担が決まっていないためメールチェックをスキップします")
+            return False
+        users = coordinator.owned(load_users())
+        counts = notify_counts
+        flush_digests(users, counts)
+        run_jobs(users, counts)
+        if idle:
+            # 常時接続モードでは定期実行のたびにセッションの起動・停止だけを行う
+            idle_manager.sync(users, counts)
+            poller_ready.set()
+            return True
+
+        poll_scheduler.sync(u["LINE_USER_ID"] for u in users if u.get("LINE_USER_ID"))
+        due = poll_scheduler.pop_all() if force else poll_scheduler.pop_due()
+        if due:
+            # 期限の早い順（前回の周回で回しきれなかったユーザーが先頭）にチェックする
+            by_id = {u.get("LINE_USER_ID"): u for u in users}
+            targets = [by_id[uid] for uid in due if uid in by_id]
+            print(f"🔍 メールチェック対象: {len(targets)}/{len(users)}人")
+            with metrics.timer("poll_cycle_seconds"), metrics.maybe_profile():
+                skipped = run_cycle(targets, lambda user: poll_user(user, counts))
+            poll_scheduler.release([u["LINE_USER_ID"] for u in skipped])
+            metrics.inc("poll_cycles_total")
+            metrics.inc("poll_carried_over_total", len(skipped))
+
+        if not poller_ready.is_set():
+            checked, total = poll_scheduler.progress()
+            if checked == total:
+                poller_ready.set()
+                print(f"🟢 起動後の初回メールチェックが完了しました（{total}人）")
+        return True
+    finally:
+        cycle_lock.release()
+
+
+def refresh_tokens():
+    users = coordinator.owned(load_users())
+    token_manager.refresh_due([u for u in users if not auth_health.blocked(u)])
+
+
+def start():
+    # 通知の送信・担当分けのハートビートのスレッドを起動する（何度呼んでもよい）
+    delivery.start()
+    coordinator.start()
+
+
+# === 実行方法 ===
+
+def run_once(drain_timeout=DRAIN_TIMEOUT):
+    # 全員を1回だけチェックし、通知を送り終えてから戻る（cron などから呼ぶ場合）。
+    # チェックできなかった場合（担当の分担が決まらない・他の周回が実行中）は False を返す
+    start()
+    # shard モードでは担当が決まるまで（ハートビート2回分）待つ
+    settle_deadline = time.monotonic() + 2 * HEARTBEAT_INTERVAL + 5
+    while not coordinator.settled() and time.monotonic() < settle_deadline:
+        time.sleep(0.5)
+    ran = poll_once(force=True, idle=False)
+    if not ran:
+        print("❌ メールチェックを実行できませんでした")
+    deadline = time.monotonic() + drain_timeout
+    while delivery.pending() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    notify_counts.snapshot()
+    return ran
+
+
+def run_forever(interval=POLL_TICK_SECONDS):
+    # 周回の開始時刻を基準に interval 秒ごとに回す（処理に時間がかかった分は待ち時間から差し引く）
+    start()
+    next_run = next_refresh = next_snapshot = time.monotonic()
+    try:
+        while True:
+            poll_once()
+            now = time.monotonic()
+            if now >= next_refresh:
+                refresh_tokens()
+                next_refresh = now + TOKEN_REFRESH_INTERVAL
+            if now >= next_snapshot:
+                notify_counts.snapshot()
+                next_snapshot = now + COUNT_SNAPSHOT_INTERVAL
+
+            next_run += interval
+            delay = next_run - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                print(f"⚠️ メールチェックが {interval} 秒を超えました（{-delay:.0f}秒超過）")
+                next_run = time.monotonic()
+    finally:
+        notify_counts.snapshot()
+
+
+def scheduled_job():
+    print("🟢 Scheduled job started")
+    poll_once()
+    print("🟢 Scheduled job finished")
+
+
+def wake(scheduler):
+    # 次のメールチェックを今すぐ実行させる（管理用のジョブを受け付けたとき）
+    scheduler.modify_job(POLL_JOB_ID, next_run_time=datetime.datetime.now(datetime.timezone.utc))
+
+
+def schedule(scheduler):
+    # APScheduler のジョブとして登録する（Web と同じプロセスでチェックする場合）
+    start()
+    # 初回は起動直後にバックグラウンドで実行する（ユーザーごとの開始時刻は POLL_START_SPREAD の範囲で散らす）。
+    # shard モードでは担当が決まるまで（HEARTBEAT_INTERVAL 以上）の周回はスキップされる
+    scheduler.add_job(
+        scheduled_job,
+        'interval',
+        id=POLL_JOB_ID,
+        seconds=POLL_TICK_SECONDS,
+        max_instances=1,
+        coalesce=True,
+        next_run_time=datetime.datetime.now(datetime.timezone.utc),
+    )
+    scheduler.add_job(refresh_tokens, 'interval', seconds=TOKEN_REFRESH_INTERVAL)
+    scheduler.add_job(notify_counts.snapshot, 'interval', seconds=COUNT_SNAPSHOT_INTERVAL)
+
+
+metrics.describe("phase_seconds", "メールチェック・トークン更新・LINE送信の各段階の処理時間")
+metrics.describe("poll_cycle_seconds", "メールチェック1周の処理時間")
+metrics.describe("notifications_total", "新着メール通知（sent: すぐ送信 / buffered: まとめ通知にためた / digest: まとめて送信）")
+metrics.gauge("delivery_outbox_pending", delivery.pending)
+metrics.gauge("delivery_queue_depth", delivery.queue.qsize)
+metrics.gauge("poll_scheduler_users", lambda: len(poll_scheduler))
+metrics.gauge("idle_sessions", lambda: len(idle_manager))
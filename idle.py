@@ -0,0 +1,184 @@
+import os
+import time
+import random
+import select
+import imaplib
+import threading
+
+
+# RFC 2177: サーバーは29分以上のIDLEを切断してよいので、それより前に張り直す
+IDLE_TIMEOUT = int(os.environ.get("IMAP_IDLE_TIMEOUT", 25 * 60))
+# IDLE非対応サーバー向けのポーリング間隔（秒）
+IDLE_FALLBACK_INTERVAL = int(os.environ.get("IMAP_IDLE_FALLBACK_INTERVAL", 60))
+RECONNECT_BACKOFF_BASE = 5
+RECONNECT_BACKOFF_MAX = 300
+
+
+def supports_idle(mail):
+    return "IDLE" in mail.capabilities
+
+
+def idle_wait(mail, timeout, should_stop):
+    # IDLE を発行し、新着（EXISTS/RECENT）・timeout・should_stop() のいずれかまで待つ。
+    # 新着があれば True を返す
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    line = mail.readline()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+    changed = False
+    deadline = time.monotonic() + timeout
+    while not changed and not should_stop():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        pending = getattr(mail.sock, "pending", None)
+        if not (pending and pending()):
+            readable, _, _ = select.select([mail.sock], [], [], min(remaining, 1.0))
+            if not readable:
+                continue
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        if line.startswith(b"* ") and (line.rstrip().endswith(b"EXISTS") or line.rstrip().endswith(b"RECENT")):
+            changed = True
+
+    mail.send(b"DONE\r\n")
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed after IDLE")
+        if line.startswith(tag):
+            break
+        if line.startswith(b"* ") and line.rstrip().endswith(b"EXISTS"):
+            changed = True
+    return changed
+
+
+class IdleSession(threading.Thread):
+    # 1ユーザー分の常時接続。認証済みの接続を保持し、IDLE（非対応ならポーリング）で新着を待つ
+
+    def __init__(self, manager, line_user_id):
+        super().__init__(name=f"idle-{line_user_id}", daemon=True)
+        self.manager = manager
+        self.line_user_id = line_user_id
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def token_changed(self, token):
+        user = self.manager.get_user(self.line_user_id)
+        return user is None or user.get("access_token") != token
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            # どんな終わり方でも一覧から外し、次の sync() で起動し直せるようにする
+            self.manager.session_finished(self)
+
+    def _run(self):
+        failures = 0
+        while not self.stop_event.is_set():
+            user = self.manager.get_user(self.line_user_id)
+            if user is None or not self.manager.eligible(user):
+                break
+
+            mail = None
+            try:
+                mail = self.manager.connect(user)
+                if mail is None:
+                    raise imaplib.IMAP4.error("認証失敗")
+                token = user["access_token"]
+                idle = supports_idle(mail)
+                print(f"[{self.line_user_id}] 🔌 常時接続を開始しました（{'IDLE' if idle else 'ポーリング'}）")
+
+                while not self.stop_event.is_set():
+                    self.manager.check(mail, user)
+                    # チェックまで通ったら失敗回数を戻す（毎回チェックで失敗する場合もバックオフさせる）
+                    failures = 0
+                    if not self.manager.eligible(user):
+                        self.stop_event.set()
+                        break
+                    if self.token_changed(token):
+                        print(f"[{self.line_user_id}] 🔑 トークンが更新されたため再接続します")
+                        break
+                    if idle:
+                        idle_wait(mail, IDLE_TIMEOUT, lambda: self.stop_event.is_set() or self.token_changed(token))
+                    else:
+                        self.stop_event.wait(IDLE_FALLBACK_INTERVAL)
+                        mail.noop()
+                    user = self.manager.get_user(self.line_user_id) or user
+            except Exception as e:
+                # 通信エラー以外（DB のロック待ち・ヘッダーの解析エラーなど）でもスレッドを終わらせず再接続する
+                failures += 1
+                delay = min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF_BASE * 2 ** (failures - 1))
+                delay = delay * random.uniform(0.5, 1.0)
+                print(f"[{self.line_user_id}] ⚠️ 常時接続エラー: {e}（{delay:.0f}秒後に再接続）")
+                self.stop_event.wait(delay)
+            finally:
+                if mail is not None:
+                    try:
+                        mail.logout()
+                    except Exception:
+                        pass
+
+
+class IdleSessionManager:
+    # ユーザーごとの IdleSession を起動・停止する。
+    # connect(user) / check(mail, user, counts) / eligible(user, counts) には engine.py の
+    # connect_imap / check_mailbox / should_check を渡す
+
+    def __init__(self, connect, check, eligible):
+        self._connect = connect
+        self._check = check
+        self._eligible = eligible
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._by_id = {}
+        self._counts = {}
+
+    def sync(self, users, counts):
+        # 最新の users / counts を反映し、対象ユーザーのセッションを起動、対象外を停止する
+        with self._lock:
+            self._by_id = {u.get("LINE_USER_ID"): u for u in users if u.get("LINE_USER_ID")}
+            self._counts = counts
+
+            wanted = {uid for uid, u in self._by_id.items() if self._eligible(u, counts)}
+            for uid, session in list(self._sessions.items()):
+                if uid not in wanted:
+                    session.stop()
+                    del self._sessions[uid]
+            for uid in wanted:
+                if uid not in self._sessions:
+                    session = IdleSession(self, uid)
+                    self._sessions[uid] = session
+                    session.start()
+
+    def session_finished(self, session):
+        with self._lock:
+            if self._sessions.get(session.line_user_id) is session:
+                del self._sessions[session.line_user_id]
+
+    def update_user(self, line_user_id, fields):
+        # トークン更新などを反映する。access_token が変わったセッションは再認証する
+        user = self._by_id.get(line_user_id)
+        if user is not None:
+            user.update(fields)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get_user(self, line_user_id):
+        return self._by_id.get(line_user_id)
+
+    def eligible(self, user):
+        return self._eligible(user, self._counts)
+
+    def connect(self, user):
+        return self._connect(user)
+
+    def check(self, mail, user):
+        self._check(mail, user, self._counts)
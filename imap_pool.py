@@ -0,0 +1,157 @@
+import os
+import ssl
+import time
+import socket
+import imaplib
+import threading
+from collections import deque
+import metrics
+from poller import time_left
+
+
+# 接続（TCP + TLS + 挨拶）と、その後の各コマンドの応答待ちのタイムアウト（秒）
+IMAP_CONNECT_TIMEOUT = float(os.environ.get("IMAP_CONNECT_TIMEOUT", 10))
+IMAP_READ_TIMEOUT = float(os.environ.get("IMAP_READ_TIMEOUT", 30))
+# サーバー証明書を検証するか（ベンチマークの自己署名証明書用に 0 にできる）
+IMAP_TLS_VERIFY = os.environ.get("IMAP_TLS_VERIFY", "1") == "1"
+# ホストごとに TLS 接続済み・未認証の接続を何本待機させておくか（0 なら使わない）と、
+# 待機させておく最長時間（秒）。未認証の接続はサーバーにすぐ切られるので短めにする
+IMAP_WARM_POOL_SIZE = int(os.environ.get("IMAP_WARM_POOL_SIZE", 0))
+IMAP_WARM_TTL = float(os.environ.get("IMAP_WARM_TTL", 20))
+
+
+def create_ssl_context(verify=IMAP_TLS_VERIFY):
+    # 全接続で使い回す SSLContext（証明書ストアの読み込みは1回だけ）
+    context = ssl.create_default_context()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class ResumableIMAP4_SSL(imaplib.IMAP4_SSL):
+    # 前回の TLS セッションを渡して、可能ならフルハンドシェイクを省く
+
+    def __init__(self, host, port, ssl_context, session=None, timeout=None):
+        self._tls_session = session
+        super().__init__(host, port, ssl_context=ssl_context, timeout=timeout)
+
+    def _create_socket(self, timeout):
+        sock = imaplib.IMAP4._create_socket(self, timeout)
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host, session=self._tls_session)
+
+
+class ImapConnector:
+
+    def __init__(self, ssl_context=None, warm_pool_size=IMAP_WARM_POOL_SIZE):
+        self.ssl_context = ssl_context or create_ssl_context()
+        self.warm_pool_size = warm_pool_size
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._warm = {}
+        self._refill = threading.Event()
+        self._refiller = None
+
+    def open(self, host, port, deadline=None):
+        # TLS 接続して挨拶を受け取るまで。TLS セッションはホストごとに覚えて次回の再開に使う。
+        # deadline（time.monotonic() 基準）を渡すと、タイムアウトをその残り時間以下にする
+        key = (host, port)
+        with metrics.timer("phase_seconds", phase="connect"):
+            mail = ResumableIMAP4_SSL(
+                host, port, self.ssl_context, session=self._sessions.get(key),
+                timeout=time_left(deadline, IMAP_CONNECT_TIMEOUT),
+            )
+        try:
+            limit_timeout(mail, deadline)
+        except TimeoutError:
+            mail.shutdown()
+            raise
+        # TLS 1.3 ではセッションチケットがハンドシェイク後に届くので、挨拶を読んだ後に取り出す
+        if mail.sock.session is not None:
+            self._sessions[key] = mail.sock.session
+        metrics.inc("imap_tls_handshakes_total", resumed=str(mail.sock.session_reused).lower())
+        return mail
+
+    def connect(self, host, port, login, deadline=None):
+        # 待機中の接続があればそれを使って login(mail) で認証する。
+        # 待機中にサーバーに切られていた場合は新しく接続し直す
+        mail = self._checkout(host, port)
+        if mail is not None:
+            try:
+                limit_timeout(mail, deadline)
+            except TimeoutError:
+                mail.shutdown()
+                raise
+            try:
+                login(mail)
+                metrics.inc("imap_warm_checkouts_total", result="used")
+                return mail
+            except (imaplib.IMAP4.abort, OSError):
+                metrics.inc("imap_warm_checkouts_total", result="stale")
+                mail.shutdown()
+
+        mail = self.open(host, port, deadline)
+        try:
+            login(mail)
+        except BaseException:
+            mail.shutdown()
+            raise
+        return mail
+
+    def _checkout(self, host, port):
+        if self.warm_pool_size <= 0:
+            return None
+        key = (host, port)
+        now = time.monotonic()
+        mail = None
+        with self._lock:
+            pool = self._warm.setdefault(key, deque())
+            while pool:
+                created, candidate = pool.popleft()
+                if now - created < IMAP_WARM_TTL:
+                    mail = candidate
+                    break
+                candidate.shutdown()
+            if self._refiller is None:
+                self._refiller = threading.Thread(target=self._refill_loop, name="imap-warm", daemon=True)
+                self._refiller.start()
+        self._refill.set()
+        return mail
+
+    def _refill_loop(self):
+        while True:
+            self._refill.wait(1)
+            self._refill.clear()
+            now = time.monotonic()
+            with self._lock:
+                wanted = []
+                for key, pool in self._warm.items():
+                    # 期限切れは捨て、足りない分を補充する
+                    while pool and now - pool[0][0] >= IMAP_WARM_TTL:
+                        pool.popleft()[1].shutdown()
+                    wanted.extend([key] * (self.warm_pool_size - len(pool)))
+            for host, port in wanted:
+                try:
+                    mail = self.open(host, port)
+                except (imaplib.IMAP4.error, OSError) as e:
+                    print(f"⚠️ 待機用のIMAP接続に失敗しました（{host}）: {e}")
+                    break
+                with self._lock:
+                    self._warm[(host, port)].append((time.monotonic(), mail))
+
+
+connector = ImapConnector()
+
+
+def limit_timeout(mail, deadline):
+    # 以降の応答待ちのタイムアウトを IMAP_READ_TIMEOUT と deadline までの残り時間の短い方にする
+    mail.sock.settimeout(time_left(deadline, IMAP_READ_TIMEOUT))
+
+
+def abort_connection(mail):
+    # 別スレッドから呼び、応答待ちで止まっている処理を OSError で抜けさせる
+    try:
+        mail.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
@@ -0,0 +1,145 @@
+import re
+from email.parser import BytesHeaderParser
+import metrics
+
+
+# 通知に必要なヘッダーだけを取得する（本文・添付ファイルはダウンロードしない）
+HEADER_FIELDS = ("FROM", "SUBJECT", "MESSAGE-ID")
+# 1コマンドあたりのUIDセット文字列の上限（サーバーのコマンド長制限対策）
+MAX_UID_SET_LENGTH = 8000
+
+_UID_RE = re.compile(rb"UID (\d+)")
+# ヘッダーしか取得しないので、本文を解析しないパーサーを使う
+_header_parser = BytesHeaderParser()
+
+# ユーザーごとの同期状態として users.db に保存するキー
+SYNC_KEYS = ("uidvalidity", "last_uid", "highestmodseq")
+
+
+def uid_set(uids):
+    # [1, 2, 3, 7, 9, 10] -> "1:3,7,9:10"
+    ranges = []
+    for uid in sorted({int(u) for u in uids}):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(f"{a}" if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+def uid_sets(uids):
+    # uid_set() を MAX_UID_SET_LENGTH ごとに分割したもの。通常は1つだけ
+    chunk = []
+    for part in uid_set(uids).split(","):
+        if part and sum(len(p) + 1 for p in chunk) + len(part) > MAX_UID_SET_LENGTH:
+            yield ",".join(chunk)
+            chunk = []
+        if part:
+            chunk.append(part)
+    if chunk:
+        yield ",".join(chunk)
+
+
+def search_uids(mail, *criteria):
+    with metrics.timer("phase_seconds", phase="search"):
+        status, data = mail.uid("SEARCH", None, *criteria)
+    if status != "OK":
+        return None
+    return [int(u) for u in data[0].split()]
+
+
+def fetch_headers(mail, uids):
+    # 指定UIDのヘッダーを1回のFETCHでまとめて取得する。{uid: Message} を返す
+    headers = {}
+    if not uids:
+        return headers
+    fields = " ".join(HEADER_FIELDS)
+    for uids_ in uid_sets(uids):
+        with metrics.timer("phase_seconds", phase="fetch"):
+            status, data = mail.uid("FETCH", uids_, f"(UID BODY.PEEK[HEADER.FIELDS ({fields})])")
+        if status != "OK":
+            continue
+        for response_part in data:
+            if isinstance(response_part, tuple):
+                m = _UID_RE.search(response_part[0])
+                if m:
+                    headers[int(m.group(1))] = _header_parser.parsebytes(response_part[1])
+    return headers
+
+
+def mark_seen(mail, uids):
+    # 既読フラグを範囲指定の STORE でまとめて付ける
+    for uids_ in uid_sets(uids):
+        with metrics.timer("phase_seconds", phase="store"):
+            mail.uid("STORE", uids_, "+FLAGS.SILENT", "(\\Seen)")
+
+
+def _response_int(mail, name):
+    # SELECT 時の応答コード（[UIDVALIDITY n] など）を取り出す。取り出した値は消える
+    typ, data = mail.response(name)
+    for value in reversed(data or []):
+        if value is None:
+            continue
+        try:
+            return int(value.split()[0])
+        except (ValueError, IndexError):
+            continue
+    return None
+
+
+def mailbox_state(mail):
+    return {
+        "uidvalidity": _response_int(mail, "UIDVALIDITY"),
+        "uidnext": _response_int(mail, "UIDNEXT"),
+        "highestmodseq": _response_int(mail, "HIGHESTMODSEQ"),
+    }
+
+
+def get_sync_state(user):
+    return {key: user.get(key) for key in SYNC_KEYS}
+
+
+def sync_new_uids(mail, sync_state, unseen_only=True):
+    # 前回までに見た最大UID（ウォーターマーク）より新しいUIDだけを返す。
+    # sync_state は {"uidvalidity", "last_uid", "highestmodseq"}。
+    # UIDVALIDITY が変わった／未同期の場合は未読を全件検索し直す（フル再同期）。
+    # 戻り値: (uids, 新しい sync_state)。検索失敗時は (None, sync_state)
+    box = mailbox_state(mail)
+    if box["uidvalidity"] is None:
+        # 常時接続で2回目以降のチェックなど、SELECT 応答が残っていない場合は変化なしとみなす
+        box["uidvalidity"] = sync_state.get("uidvalidity")
+    last_uid = sync_state.get("last_uid")
+    full = last_uid is None or sync_state.get("uidvalidity") != box["uidvalidity"]
+
+    if full:
+        if last_uid is not None:
+            print(f"⚠️ UIDVALIDITY が変わったため再同期します（{sync_state.get('uidvalidity')} → {box['uidvalidity']}）")
+        uids = search_uids(mail, "UNSEEN")
+        if uids is None:
+            return None, sync_state
+        if box["uidnext"]:
+            top = box["uidnext"] - 1
+        else:
+            top = max(search_uids(mail, "UID", "*") or [0])
+    elif box["highestmodseq"] is not None and box["highestmodseq"] == sync_state.get("highestmodseq"):
+        # CONDSTORE: メールボックスに変更なし
+        uids, top = [], last_uid
+    elif box["uidnext"] is not None and box["uidnext"] <= last_uid + 1:
+        uids, top = [], last_uid
+    else:
+        criteria = ["UID", f"{last_uid + 1}:*"]
+        if unseen_only:
+            criteria.append("UNSEEN")
+        uids = search_uids(mail, *criteria)
+        if uids is None:
+            return None, sync_state
+        # "n:*" は n より大きいUIDが無くても最後の1通を返すので除外する
+        uids = [u for u in uids if u > last_uid]
+        top = max(last_uid, (box["uidnext"] or 1) - 1)
+
+    new_state = {
+        "uidvalidity": box["uidvalidity"],
+        "last_uid": max([top or 0] + uids),
+        "highestmodseq": box["highestmodseq"],
+    }
+    return uids, new_state
@@ -0,0 +1,102 @@
+import os
+import time
+import uuid
+from collections import Counter
+
+
+# 管理用 API（/admin/jobs）から受け付けたメールチェックのジョブ。
+# ジョブは users.db に保存するので、Web のどのワーカーからでも登録・確認できる。
+# 実行するのはメールチェックを担当しているプロセス（APScheduler か checker.py）で、
+# 周回のたびに自分の担当ユーザーのうち未チェックの分を users.db 上で取り出してチェックする
+# （engine.run_jobs）。取り出しはユーザーごとなので、同じユーザーを2つのプロセスが同時にチェックすることはない
+
+# 受け付けてからこの秒数で終わらなかったジョブは打ち切る（残りのユーザーは carried_over）
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", 60 * 60))
+# 取り出したまま結果が保存されないユーザー（プロセスが落ちたなど）を取り出し直せるようにするまでの秒数
+JOB_CLAIM_TTL = 15 * 60
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+EXPIRED = "expired"
+
+# ジョブの対象のうち、まだ結果がないユーザーの状態
+PENDING = "pending"            # まだ順番が来ていない
+CHECKING = "checking"          # チェック中
+CARRIED_OVER = "carried_over"  # 時間内にチェックできなかった
+NOT_FOUND = "not_found"        # 登録されていない
+
+
+def submit(store, line_user_ids=None):
+    # 戻り値: (ジョブ, 新しく受け付けたか)。全員のチェック（line_user_ids が None）は同時に1件しか受け付けず、
+    # 未完了のものがあればそのジョブを返す
+    known = [u["LINE_USER_ID"] for u in store.all() if u.get("LINE_USER_ID")]
+    if line_user_ids is None:
+        requested, targets, not_found = None, known, []
+    else:
+        requested = targets = list(dict.fromkeys(line_user_ids))
+        known = set(known)
+        not_found = [uid for uid in requested if uid not in known]
+    job_id, created = store.create_job(uuid.uuid4().hex, requested, targets, not_found, time.time() - JOB_TIMEOUT)
+    return get(store, job_id), created
+
+
+def get(store, job_id):
+    job = store.get_job(job_id)
+    return None if job is None else describe(job)
+
+
+def pending(store):
+    # 未完了のジョブと、まだ誰も取り出していないユーザー
+    now = time.time()
+    return store.pending_jobs(now - JOB_TIMEOUT, now - JOB_CLAIM_TTL)
+
+
+def describe(job):
+    now = time.time()
+    deadline = job["created_at"] + JOB_TIMEOUT
+    if job["finished_at"]:
+        status = DONE
+    elif deadline < now:
+        status = EXPIRED
+    elif job["started_at"]:
+        status = RUNNING
+    else:
+        status = QUEUED
+
+    users = {}
+    checked = 0
+    for uid in job["targets"]:
+        result = job["results"].get(uid)
+        if result is None or result["outcome"] is None:
+            unchecked = CARRIED_OVER if status == EXPIRED else (CHECKING if result else PENDING)
+            users[uid] = {"outcome": unchecked}
+            continue
+        checked += 1
+        users[uid] = {key: value for key, value in result.items() if value is not None}
+
+    started = job["started_at"]
+    end = job["finished_at"] or min(now, deadline)
+    return {
+        "id": job["id"],
+        "status": status,
+        "users": job["requested"],
+        "progress": {"checked": checked, "total": len(job["targets"])},
+        "outcomes": dict(Counter(result["outcome"] for result in users.values())),
+        "created_at": job["created_at"],
+        "started_at": started,
+        "finished_at": job["finished_at"],
+        "seconds": round(end - started, 3) if started else None,
+        "results": users,
+    }
+
+
+class JobReport:
+    # poll_user() からユーザーごとの結果を受け取って保存する
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+
+    def record(self, line_user_id, outcome, new_mail, seconds):
+        self.store.record_job_result(self.job_id, line_user_id, outcome, new_mail, round(seconds, 3))
@@ -0,0 +1,191 @@
+import os
+import sys
+import time
+import random
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+
+
+# メールチェックの各段階の処理時間・件数を集計し、/metrics で Prometheus のテキスト形式で返す
+METRICS_PREFIX = "merutsuuchi_"
+# 処理時間のヒストグラムのバケット（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# 周回をサンプリングプロファイルする割合（0 なら無効）と、スタックを採る間隔（秒）
+PROFILE_CYCLE_RATE = float(os.environ.get("PROFILE_CYCLE_RATE", 0))
+PROFILE_INTERVAL = 0.01
+PROFILE_DIR = "./persistent/profiles"
+PROFILE_KEEP = 20
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_help = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def describe(name, text):
+    _help[name] = text
+
+
+def inc(name, n=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            # [各バケットの件数..., +Inf の件数, 合計]
+            h = _histograms[key] = [0] * (len(DURATION_BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                h[i] += 1
+                break
+        else:
+            h[len(DURATION_BUCKETS)] += 1
+        h[-1] += value
+
+
+def gauge(name, fn, **labels):
+    # fn() の値を /metrics の出力時に読む（キューの長さなど）
+    with _lock:
+        _gauges[_key(name, labels)] = fn
+
+
+@contextmanager
+def timer(name, **labels):
+    # with timer("phase_seconds", phase="fetch"): ... の処理時間を記録する（例外時も記録する）
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def timed(name, **labels):
+    # 関数全体の処理時間を記録するデコレーター（Flask のルート用）
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+
+def render():
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+        gauges = dict(_gauges)
+
+    lines = []
+    seen = set()
+
+    def header(name, kind):
+        if name in seen:
+            return
+        seen.add(name)
+        if name in _help:
+            lines.append(f"# HELP {METRICS_PREFIX}{name} {_help[name]}")
+        lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append(f"{METRICS_PREFIX}{name}{_labels(labels)} {value}")
+
+    for (name, labels), fn in sorted(gauges.items(), key=lambda item: item[0]):
+        try:
+            value = fn()
+        except Exception:
+            continue
+        header(name, "gauge")
+        lines.append(f"{METRICS_PREFIX}{name}{_labels(labels)} {value}")
+
+    for (name, labels), h in sorted(histograms.items()):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(DURATION_BUCKETS, h):
+            cumulative += count
+            lines.append(f"{METRICS_PREFIX}{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+        cumulative += h[len(DURATION_BUCKETS)]
+        lines.append(f"{METRICS_PREFIX}{name}_bucket{_labels(labels, [('le', '+Inf')])} {cumulative}")
+        lines.append(f"{METRICS_PREFIX}{name}_sum{_labels(labels)} {h[-1]:.6f}")
+        lines.append(f"{METRICS_PREFIX}{name}_count{_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+class StackSampler:
+    # 周回中の全スレッドのスタックを一定間隔で採り、collapsed 形式（flamegraph.pl / speedscope で読める）で書き出す。
+    # cProfile は呼び出したスレッドしか計測できないため、ワーカースレッドで動くメールチェックにはこちらを使う
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                thread = names.get(ident, str(ident)).rsplit("_", 1)[0]
+                self.stacks[";".join([thread] + stack[::-1])] += 1
+
+    def save(self, directory=PROFILE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, time.strftime("cycle-%Y%m%d-%H%M%S.folded"))
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        # 古いものから消して PROFILE_KEEP 件だけ残す
+        files = sorted(p for p in os.listdir(directory) if p.endswith(".folded"))
+        for old in files[:-PROFILE_KEEP]:
+            os.remove(os.path.join(directory, old))
+        return path
+
+
+@contextmanager
+def maybe_profile(rate=PROFILE_CYCLE_RATE):
+    # rate の確率で周回をサンプリングプロファイルする
+    if rate <= 0 or random.random() >= rate:
+        yield
+        return
+    with StackSampler() as sampler:
+        yield
+    path = sampler.save()
+    print(f"🔬 周回のプロファイルを保存しました: {path}（{sum(sampler.stacks.values())}サンプル）")
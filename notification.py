@@ -0,0 +1,96 @@
+import os
+from functools import lru_cache
+from collections import namedtuple
+from email.header import decode_header
+from email.utils import parseaddr
+
+
+# 新着メール通知の本文を組み立てる。
+# 差出人は同じものが何度も来るので、デコード結果をキャッシュしておく
+
+# LINE のテキストメッセージの上限（文字数。絵文字などは UTF-16 で2文字と数える）
+LINE_TEXT_LIMIT = 5000
+# 1件の件名・差出人として表示する最大文字数
+SUBJECT_MAX_CHARS = 200
+SENDER_MAX_CHARS = 100
+SENDER_CACHE_SIZE = int(os.environ.get("SENDER_CACHE_SIZE", 4096))
+
+# 通知1件分のメール（デコード済みの差出人と件名）
+Mail = namedtuple("Mail", ["sender", "subject"])
+
+HEADER = "📩 新着メール通知\n\n"
+OTHERS = "\n\n他 {others} 件の未読メールあり"
+FOOTER = (
+    "\n\n-----\n\n"
+    "✅ 通知回数：{notify_count}/{notify_limit}回\n\n"
+    "通知上限に達した場合は、\n"
+    "X（旧Twitter）のDMでご連絡ください。\n"
+    "👉 https://x.com/job_akira\n\n"
+    "※今後プレミアムプラン（通知回数無制限）も予定しています。\n\n"
+    "-----\n\n"
+    "🙏 メル通知の運営は皆様の応援で継続できています。\n"
+    "もしサービスの継続・発展を応援いただける場合は、\n"
+    "100円から支援いただけるととても励みになります。\n\n"
+    "👉 https://qr.paypay.ne.jp/p2p01_NiHbdLbDfyqQRRa0"
+)
+
+
+def decode_mime_words(s):
+    if not s:
+        return ""
+    fragments = []
+    for fragment, encoding in decode_header(s):
+        if isinstance(fragment, bytes):
+            try:
+                fragment = fragment.decode(encoding or "utf-8", errors="ignore")
+            except LookupError:
+                # 不明な文字コード名は UTF-8 とみなす
+                fragment = fragment.decode("utf-8", errors="ignore")
+        fragments.append(fragment)
+    return "".join(fragments)
+
+
+def header_text(value):
+    # 生の 8bit 文字（エンコードされていない日本語など）を含むヘッダーは str ではなく Header になるので、
+    # デコードして str にそろえる
+    if value is None or isinstance(value, str):
+        return value
+    return decode_mime_words(value)
+
+
+def parse_sender(raw_from):
+    # From ヘッダーから (表示用の差出人, メールアドレス) を返す
+    return _parse_sender(header_text(raw_from))
+
+
+@lru_cache(maxsize=SENDER_CACHE_SIZE)
+def _parse_sender(raw_from):
+    return decode_mime_words(raw_from), parseaddr(raw_from)[1]
+
+
+def text_length(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _shorten(text, limit):
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def render(mails, others, notify_count, notify_limit):
+    # LINE_TEXT_LIMIT に収まるだけメールを並べ、入りきらない分は「他 N 件」に含める
+    footer = FOOTER.format(notify_count=notify_count, notify_limit=notify_limit)
+    # 「他 N 件」の行は件数が増えても収まるよう、桁数に余裕をもって見積もる
+    budget = LINE_TEXT_LIMIT - text_length(HEADER) - text_length(footer) - text_length(OTHERS) - 10
+    lines = []
+    for i, mail in enumerate(mails):
+        line = f"👤 {_shorten(mail.sender, SENDER_MAX_CHARS)}\n📝 {_shorten(mail.subject, SUBJECT_MAX_CHARS)}"
+        budget -= text_length(line) + 1
+        if budget < 0:
+            others += len(mails) - i
+            break
+        lines.append(line)
+    body = HEADER + "\n".join(lines)
+    if others > 0:
+        body += OTHERS.format(others=others)
+    return body + footer
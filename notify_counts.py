@@ -0,0 +1,114 @@
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+
+
+# 何回増えたらスナップショットを取り直すか（定期実行でも snapshot() を呼ぶ）
+SNAPSHOT_EVERY = int(os.environ.get("NOTIFY_COUNT_SNAPSHOT_EVERY", 500))
+
+
+class NotifyCounter:
+    # 通知回数をメモリ上で管理する。
+    # 増分は追記専用のジャーナル（"LINE_USER_ID\t回数" の行）に書き、
+    # 定期的に JSON のスナップショットへまとめる（一時ファイル → os.replace で置き換え）。
+    # 起動時はスナップショットを読み、ジャーナルを上から適用し直す。
+    # 複数プロセスで同じファイルを使えるよう、ファイル操作は .lock の flock で排他する
+
+    def __init__(self, path, snapshot_every=SNAPSHOT_EVERY):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.snapshot_every = snapshot_every
+        self._lock = threading.Lock()
+        self._since_snapshot = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(path + ".lock", "a")
+        with self._file_lock():
+            self._counts = self._load()
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    @contextmanager
+    def _file_lock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                counts = json.load(f)
+        except FileNotFoundError:
+            print("⚠️ 通知回数ファイルが存在しません。初期化します。")
+            counts = {}
+
+        replayed = 0
+        torn_tail = None
+        try:
+            with open(self.journal_path, "rb") as f:
+                offset = 0
+                for raw in f:
+                    # 書き込み途中で落ちた最後の行（改行なし）は読み飛ばす
+                    if not raw.endswith(b"\n"):
+                        torn_tail = offset
+                        break
+                    offset += len(raw)
+                    parts = raw[:-1].decode("utf-8", errors="replace").split("\t")
+                    if len(parts) != 2 or not parts[1].isdigit():
+                        continue
+                    counts[parts[0]] = int(parts[1])
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        if torn_tail is not None:
+            # 改行で終わっていない最後の行を切り捨ててから追記を再開する
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(torn_tail)
+        if replayed:
+            print(f"✅ 通知回数のジャーナルを {replayed} 件適用しました")
+        return counts
+
+    def get(self, line_user_id, default=0):
+        return self._counts.get(line_user_id, default)
+
+    def increment(self, line_user_id):
+        with self._lock:
+            count = self._counts.get(line_user_id, 0) + 1
+            self._counts[line_user_id] = count
+            with self._file_lock():
+                self._journal.write(f"{line_user_id}\t{count}\n")
+                self._journal.flush()
+            self._since_snapshot += 1
+            if self._since_snapshot >= self.snapshot_every:
+                self._snapshot()
+        return count
+
+    def reload(self):
+        # 他のプロセスが増やした回数も含めて読み直す（担当ユーザーが変わったとき用）
+        with self._lock, self._file_lock():
+            self._counts = self._load()
+
+    def snapshot(self):
+        with self._lock:
+            if self._since_snapshot:
+                self._snapshot()
+
+    def _snapshot(self):
+        # メモリ上の値ではなくファイルの内容をまとめ直す（他プロセス分の増分を消さないため）
+        with self._file_lock():
+            counts = self._load()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(counts, f, indent=2, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            # スナップショットに反映済みなのでジャーナルを空にする
+            with open(self.journal_path, "w"):
+                pass
+        self._counts.update(counts)
+        self._since_snapshot = 0
@@ -0,0 +1,147 @@
+import os
+import time
+import heapq
+import random
+import threading
+
+
+# チェック結果
+NEW_MAIL = "new_mail"
+NO_MAIL = "no_mail"
+AT_LIMIT = "at_limit"
+NOT_READY = "not_ready"
+AUTH_FAILED = "auth_failed"
+CIRCUIT_OPEN = "circuit_open"
+ERROR = "error"
+
+# ユーザーごとのチェック間隔（秒）。新着の多いユーザーほど短くなる
+POLL_MIN_INTERVAL = int(os.environ.get("POLL_MIN_INTERVAL", 60))
+POLL_MAX_INTERVAL = int(os.environ.get("POLL_MAX_INTERVAL", 15 * 60))
+POLL_BASE_INTERVAL = int(os.environ.get("POLL_BASE_INTERVAL", 5 * 60))
+# 間隔に掛けるゆらぎ（±割合）と、起動直後の初回チェックを散らす幅（秒）
+POLL_JITTER = float(os.environ.get("POLL_JITTER", 0.1))
+POLL_START_SPREAD = int(os.environ.get("POLL_START_SPREAD", 60))
+# 通知上限に達したユーザーの再確認間隔。
+# 認証待ち・再認証待ちのユーザーは通信しないので、認証完了後すぐ拾えるよう短くしておく
+AT_LIMIT_INTERVAL = 60 * 60
+NOT_READY_INTERVAL = 60
+# 認証できないユーザー・一時的なエラーのバックオフ（倍々で伸ばす）
+AUTH_FAILED_BACKOFF = (10 * 60, 6 * 60 * 60)
+ERROR_BACKOFF = (60, 30 * 60)
+# 新着頻度の指数移動平均の重み
+RATE_ALPHA = 0.3
+
+
+class PollScheduler:
+    # 次にチェックすべき時刻順にユーザーを並べる優先度付きキュー。
+    # pop_due() で取り出したユーザーは record() で結果を返すまでキューに戻らない
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._due = {}
+        self._inflight = set()
+        self._interval = {}
+        self._rate = {}
+        self._last_check = {}
+        self._failures = {}
+
+    def sync(self, line_user_ids, now=None):
+        # 新しいユーザーを追加し、いなくなったユーザーを外す
+        now = now or time.time()
+        line_user_ids = set(line_user_ids)
+        with self._lock:
+            for uid in list(self._due):
+                if uid not in line_user_ids:
+                    self._forget(uid)
+            for uid in line_user_ids:
+                if uid not in self._due and uid not in self._inflight:
+                    self._schedule(uid, now + random.uniform(0, POLL_START_SPREAD))
+
+    def _forget(self, uid):
+        for table in (self._due, self._interval, self._rate, self._last_check, self._failures):
+            table.pop(uid, None)
+
+    def _schedule(self, uid, due):
+        self._due[uid] = due
+        heapq.heappush(self._heap, (due, uid))
+
+    def pop_due(self, now=None, limit=None):
+        now = now or time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+                at, uid = heapq.heappop(self._heap)
+                if self._due.get(uid) != at:
+                    continue  # 再スケジュール済み・削除済みの古いエントリ
+                del self._due[uid]
+                self._inflight.add(uid)
+                due.append(uid)
+        return due
+
+    def pop_all(self):
+        # 期限に関係なく全員を取り出す（手動実行用）
+        with self._lock:
+            uids = list(self._due)
+            self._due.clear()
+            self._heap = []
+            self._inflight.update(uids)
+        return uids
+
+    def pop(self, uids):
+        # 指定したユーザーだけを期限に関係なく取り出す（手動実行用）。キューにいないユーザーは返さない
+        with self._lock:
+            taken = [uid for uid in dict.fromkeys(uids) if uid in self._due]
+            for uid in taken:
+                del self._due[uid]
+                self._inflight.add(uid)
+        return taken
+
+    def release(self, uids):
+        # 取り出したもののチェックできなかったユーザーを、次の pop_due() で真っ先に返るよう戻す
+        with self._lock:
+            for i, uid in enumerate(uids):
+                if uid in self._inflight:
+                    self._inflight.discard(uid)
+                    self._schedule(uid, i)
+
+    def record(self, uid, outcome, new_mail=0, now=None):
+        now = now or time.time()
+        with self._lock:
+            self._inflight.discard(uid)
+            interval = self._next_interval(uid, outcome, new_mail, now)
+            self._last_check[uid] = now
+            jitter = random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+            self._schedule(uid, now + interval * jitter)
+
+    def _next_interval(self, uid, outcome, new_mail, now):
+        if outcome in (AUTH_FAILED, ERROR):
+            failures = self._failures.get(uid, 0) + 1
+            self._failures[uid] = failures
+            base, cap = AUTH_FAILED_BACKOFF if outcome == AUTH_FAILED else ERROR_BACKOFF
+            return min(cap, base * 2 ** (failures - 1))
+        self._failures.pop(uid, None)
+        if outcome == AT_LIMIT:
+            return AT_LIMIT_INTERVAL
+        if outcome in (NOT_READY, CIRCUIT_OPEN):
+            return NOT_READY_INTERVAL
+
+        # 新着頻度（通/秒）を指数移動平均で更新し、1回のチェックで1通程度になる間隔にする
+        elapsed = now - self._last_check.get(uid, now - self._interval.get(uid, POLL_BASE_INTERVAL))
+        observed = new_mail / max(elapsed, 1)
+        rate = self._rate.get(uid)
+        rate = observed if rate is None else RATE_ALPHA * observed + (1 - RATE_ALPHA) * rate
+        self._rate[uid] = rate
+        interval = 1 / rate if rate > 0 else POLL_MAX_INTERVAL
+        interval = max(POLL_MIN_INTERVAL, min(POLL_MAX_INTERVAL, interval))
+        self._interval[uid] = interval
+        return interval
+
+    def progress(self):
+        # (1回以上チェックしたユーザー数, 全ユーザー数)
+        with self._lock:
+            known = set(self._due) | self._inflight
+            return sum(1 for uid in known if uid in self._last_check), len(known)
+
+    def __len__(self):
+        return len(self._due) + len(self._inflight)
@@ -0,0 +1,109 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# 同時にチェックするユーザー数と、同一IMAPホストへの同時接続数の上限
+POLL_CONCURRENCY = int(os.environ.get("POLL_CONCURRENCY", 20))
+IMAP_HOST_LIMIT = int(os.environ.get("IMAP_HOST_LIMIT", 10))
+# 1周にかける時間の上限（秒）。超えたら残りのユーザーは次の周回に回す
+POLL_CYCLE_BUDGET = float(os.environ.get("POLL_CYCLE_BUDGET", 5 * 60))
+# 1ユーザーのチェックにかける時間の上限（秒）。超えたら接続を切る
+POLL_USER_DEADLINE = float(os.environ.get("POLL_USER_DEADLINE", 60))
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+
+def host_slot(host):
+    # ホストごとのセマフォ。with host_slot(host): で接続数を制限する
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = threading.BoundedSemaphore(IMAP_HOST_LIMIT)
+            _host_slots[host] = slot
+    return slot
+
+
+class Watchdog:
+    # 期限を過ぎたら callback() を呼ぶ。ユーザーごとにタイマースレッドを立てないよう1本のスレッドで見張る
+
+    def __init__(self, resolution=0.5):
+        self.resolution = resolution
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = itertools.count()
+        self._thread = None
+
+    def watch(self, timeout, callback):
+        # 戻り値の Event を set すると取り消す
+        cancelled = threading.Event()
+        with self._lock:
+            heapq.heappush(self._heap, (time.monotonic() + timeout, next(self._seq), callback, cancelled))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="watchdog", daemon=True)
+                self._thread.start()
+        return cancelled
+
+    def _run(self):
+        while True:
+            time.sleep(self.resolution)
+            now = time.monotonic()
+            expired = []
+            with self._lock:
+                while self._heap and (self._heap[0][0] <= now or self._heap[0][3].is_set()):
+                    _, _, callback, cancelled = heapq.heappop(self._heap)
+                    if not cancelled.is_set():
+                        expired.append(callback)
+            for callback in expired:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"⚠️ タイムアウト処理でエラー: {e}")
+
+
+watchdog = Watchdog()
+
+
+def time_left(deadline, limit=None):
+    # deadline（time.monotonic() 基準。None なら期限なし）までの残り秒数を limit 以下にして返す。
+    # 期限を過ぎていれば TimeoutError
+    if deadline is None:
+        return limit
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise TimeoutError("deadline exceeded")
+    return left if limit is None else min(limit, left)
+
+
+def run_cycle(users, check, concurrency=None, budget=None):
+    # check(user) を並列に実行する。1ユーザーの例外は他のユーザーに影響させない。
+    # budget 秒を過ぎてから順番が来たユーザーはチェックせず、戻り値のリストで返す（次の周回に回す）
+    budget = POLL_CYCLE_BUDGET if budget is None else budget
+    deadline = time.monotonic() + budget if budget > 0 else None
+    skipped = []
+
+    def run_one(user):
+        if deadline is not None and time.monotonic() >= deadline:
+            skipped.append(user)
+            return
+        try:
+            with host_slot(user.get("IMAP_SERVER") or "imap.gmail.com"):
+                # ホストの空き待ちで予算を使い切った場合も回す
+                if deadline is not None and time.monotonic() >= deadline:
+                    skipped.append(user)
+                    return
+                check(user)
+        except Exception as e:
+            print(f"[{user.get('LINE_USER_ID', '不明')}] ❌ メールチェック中にエラー: {e}")
+
+    workers = max(1, min(concurrency or POLL_CONCURRENCY, len(users) or 1))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poller") as pool:
+        for _ in pool.map(run_one, users):
+            pass
+    if skipped:
+        print(f"⏱️ 周回の時間上限（{budget:.0f}秒）に達したため {len(skipped)}人を次の周回に回します")
+    return skipped
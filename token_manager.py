@@ -0,0 +1,138 @@
+import os
+import datetime
+import threading
+import requests
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import metrics
+from poller import time_left
+
+
+# ベンチマークではローカルのダミーサーバーに向ける（bench/）
+TOKEN_URL = os.environ.get("GOOGLE_TOKEN_URL", "https://oauth2.googleapis.com/token")
+# 有効期限の何秒前になったら先回りして更新するか
+TOKEN_REFRESH_MARGIN = int(os.environ.get("TOKEN_REFRESH_MARGIN", 300))
+TOKEN_REFRESH_CONCURRENCY = int(os.environ.get("TOKEN_REFRESH_CONCURRENCY", 8))
+# Google への HTTP リクエストの (接続, 読み込み) タイムアウト（秒）
+HTTP_TIMEOUT = (
+    float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5)),
+    float(os.environ.get("HTTP_READ_TIMEOUT", 15)),
+)
+
+# Google へのHTTP接続はこのセッションで使い回す
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+
+def parse_expiry(value):
+    # token_expiry は UTC の ISO 形式（タイムゾーンなし）で保存している
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def expiry_after(expires_in):
+    return (datetime.datetime.utcnow() + datetime.timedelta(seconds=int(expires_in or 3600))).isoformat()
+
+
+def _error_code(res):
+    try:
+        return res.json().get("error")
+    except ValueError:
+        return None
+
+
+class TokenManager:
+    # アクセストークンの更新をまとめて扱う。
+    # on_refresh(line_user_id, fields) で更新後の access_token / token_expiry を保存する。
+    # リフレッシュトークンが失効・取り消されていた場合は on_revoked(user) を呼ぶ
+
+    def __init__(self, client_id, client_secret, on_refresh, on_revoked=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.on_refresh = on_refresh
+        self.on_revoked = on_revoked
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def needs_refresh(self, user, margin=TOKEN_REFRESH_MARGIN):
+        expiry = parse_expiry(user.get("token_expiry"))
+        if expiry is None:
+            return False
+        return expiry - datetime.timedelta(seconds=margin) <= datetime.datetime.utcnow()
+
+    def refresh(self, user, deadline=None):
+        # 同じユーザーの更新が同時に走った場合は、最初の1件の結果を共有する。
+        # deadline（time.monotonic() 基準）を過ぎそうなら TimeoutError
+        line_user_id = user["LINE_USER_ID"]
+        with self._lock:
+            pending = self._inflight.get(line_user_id)
+            owner = pending is None
+            if owner:
+                pending = self._inflight[line_user_id] = Future()
+        if not owner:
+            return pending.result(timeout=time_left(deadline))
+
+        access_token = None
+        try:
+            access_token = self._request(user, deadline)
+        finally:
+            with self._lock:
+                del self._inflight[line_user_id]
+            pending.set_result(access_token)
+        return access_token
+
+    def _request(self, user, deadline=None):
+        data = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "refresh_token": user["refresh_token"],
+            "grant_type": "refresh_token",
+        }
+        try:
+            with metrics.timer("phase_seconds", phase="token_refresh"):
+                timeout = tuple(time_left(deadline, t) for t in HTTP_TIMEOUT)
+                res = session.post(TOKEN_URL, data=data, timeout=timeout)
+        except requests.RequestException as e:
+            # 期限を使い切ってのタイムアウトなら更新の失敗とはせず TimeoutError にする
+            time_left(deadline)
+            print(f"[{user['LINE_USER_ID']}] トークン更新失敗:", e)
+            metrics.inc("token_refreshes_total", result="error")
+            return None
+        if res.status_code != 200:
+            print(f"[{user['LINE_USER_ID']}] トークン更新失敗:", res.text)
+            if res.status_code in (400, 401) and _error_code(res) == "invalid_grant":
+                metrics.inc("token_refreshes_total", result="revoked")
+                if self.on_revoked:
+                    self.on_revoked(user)
+            else:
+                metrics.inc("token_refreshes_total", result="rejected")
+            return None
+        metrics.inc("token_refreshes_total", result="ok")
+
+        token_response = res.json()
+        fields = {
+            "access_token": token_response["access_token"],
+            "token_expiry": expiry_after(token_response.get("expires_in")),
+        }
+        if token_response.get("refresh_token"):
+            fields["refresh_token"] = token_response["refresh_token"]
+        user.update(fields)
+        self.on_refresh(user["LINE_USER_ID"], fields)
+        return fields["access_token"]
+
+    def refresh_due(self, users):
+        # 有効期限が近いユーザーのトークンをまとめて更新する（バックグラウンド実行用）
+        due = [
+            u for u in users
+            if u.get("LINE_USER_ID") and u.get("refresh_token") and self.needs_refresh(u)
+        ]
+        if not due:
+            return 0
+        with ThreadPoolExecutor(max_workers=TOKEN_REFRESH_CONCURRENCY, thread_name_prefix="token") as pool:
+            refreshed = sum(1 for token in pool.map(self.refresh, due) if token)
+        print(f"🔑 トークンを先行更新しました（{refreshed}/{len(due)}件）")
+        return refreshed
@@ -0,0 +1,378 @@
+import os
+import json
+import time
+import random
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# ユーザー情報の保存先（SQLite / WALモード）。
+# LINE_USER_ID・state・EMAIL_ADDRESS で索引を引き、1ユーザー単位で更新する
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    line_user_id  TEXT PRIMARY KEY,
+    state         TEXT,
+    email_address TEXT,
+    data          TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_state ON users(state);
+CREATE INDEX IF NOT EXISTS users_email_address ON users(email_address);
+CREATE TABLE IF NOT EXISTS webhook_events (
+    event_id    TEXT PRIMARY KEY,
+    received_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS notified (
+    line_user_id TEXT NOT NULL,
+    key_hash     INTEGER NOT NULL,
+    notified_at  REAL NOT NULL,
+    PRIMARY KEY (line_user_id, key_hash)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS digest (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    line_user_id TEXT NOT NULL,
+    subjects     TEXT NOT NULL,
+    others       INTEGER NOT NULL,
+    due_at       REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS digest_line_user_id ON digest(line_user_id);
+CREATE INDEX IF NOT EXISTS digest_due_at ON digest(due_at);
+CREATE TABLE IF NOT EXISTS jobs (
+    id          TEXT PRIMARY KEY,
+    requested   TEXT,
+    targets     TEXT NOT NULL,
+    total       INTEGER NOT NULL,
+    checked     INTEGER NOT NULL,
+    created_at  REAL NOT NULL,
+    started_at  REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs(created_at);
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id       TEXT NOT NULL,
+    line_user_id TEXT NOT NULL,
+    outcome      TEXT,
+    new_mail     INTEGER,
+    seconds      REAL,
+    worker_id    TEXT,
+    claimed_at   REAL NOT NULL,
+    PRIMARY KEY (job_id, line_user_id)
+) WITHOUT ROWID;
+"""
+# 再送された Webhook イベントを判定するために ID を保持しておく期間（秒）
+WEBHOOK_EVENT_TTL = 24 * 60 * 60
+# 管理用のジョブ（jobs.py）の記録を残しておく期間（秒）
+JOB_TTL = 7 * 24 * 60 * 60
+# 通知済みメール（UID・Message-ID）をユーザーごとに何件・何秒覚えておくか
+NOTIFIED_CACHE_SIZE = int(os.environ.get("NOTIFIED_CACHE_SIZE", 500))
+NOTIFIED_TTL = int(os.environ.get("NOTIFIED_TTL", 30 * 24 * 60 * 60))
+
+
+def _key_hash(key):
+    # キーは 64bit のハッシュ値だけを保存する（衝突で通知が漏れる確率は無視できる）
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big", signed=True)
+
+
+class UserStore:
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        # sqlite3 の接続はスレッドごとに持つ
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _row(user):
+        return (
+            user["LINE_USER_ID"],
+            user.get("state") or None,
+            user.get("EMAIL_ADDRESS") or None,
+            json.dumps(user, ensure_ascii=False),
+        )
+
+    def _one(self, where, value):
+        row = self._conn().execute(f"SELECT data FROM users WHERE {where} = ? LIMIT 1", (value,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all(self):
+        rows = self._conn().execute("SELECT data FROM users ORDER BY rowid").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, line_user_id):
+        return self._one("line_user_id", line_user_id)
+
+    def find_by_state(self, state):
+        if not state:
+            return None
+        return self._one("state", state)
+
+    def find_by_email(self, email_address):
+        if not email_address:
+            return None
+        return self._one("email_address", email_address)
+
+    def add(self, user):
+        # 既に同じ LINE_USER_ID がいれば何もしない。追加できたら True
+        cur = self._conn().execute(
+            "INSERT OR IGNORE INTO users (line_user_id, state, email_address, data) VALUES (?, ?, ?, ?)",
+            self._row(user),
+        )
+        return cur.rowcount == 1
+
+    def _update_where(self, where, value, fields):
+        with self.transaction() as conn:
+            row = conn.execute(f"SELECT data FROM users WHERE {where} = ? LIMIT 1", (value,)).fetchone()
+            if row is None:
+                return None
+            user = json.loads(row[0])
+            user.update(fields)
+            conn.execute(
+                "UPDATE users SET state = ?, email_address = ?, data = ? WHERE line_user_id = ?",
+                self._row(user)[1:] + (user["LINE_USER_ID"],),
+            )
+        return user
+
+    def update(self, line_user_id, **fields):
+        # 1ユーザー分だけを更新して、更新後のユーザーを返す（存在しなければ None）
+        return self._update_where("line_user_id", line_user_id, fields)
+
+    def update_by_state(self, state, **fields):
+        if not state:
+            return None
+        return self._update_where("state", state, fields)
+
+    def claim_webhook_event(self, event_id):
+        # 初めて受け取ったイベントなら True。再送（同じ webhookEventId）なら False
+        conn = self._conn()
+        now = time.time()
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM webhook_events WHERE received_at < ?", (now - WEBHOOK_EVENT_TTL,))
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO webhook_events (event_id, received_at) VALUES (?, ?)", (event_id, now)
+        )
+        return cur.rowcount == 1
+
+    def notified(self, line_user_id, keys):
+        # keys のうち通知済みのものを返す
+        keys = list(keys)
+        if not keys:
+            return set()
+        hashes = {_key_hash(k): k for k in keys}
+        since = time.time() - NOTIFIED_TTL
+        found = set()
+        chunk = list(hashes)
+        # SQLite のパラメータ数の上限を超えないよう分けて問い合わせる
+        for i in range(0, len(chunk), 500):
+            part = chunk[i:i + 500]
+            rows = self._conn().execute(
+                "SELECT key_hash FROM notified WHERE line_user_id = ? AND notified_at >= ? "
+                f"AND key_hash IN ({','.join('?' * len(part))})",
+                (line_user_id, since, *part),
+            )
+            found.update(hashes[row[0]] for row in rows)
+        return found
+
+    def remember_notified(self, line_user_id, keys):
+        # 通知したメールのキーを記録し、古いものから NOTIFIED_CACHE_SIZE 件を超えた分と期限切れを消す
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO notified (line_user_id, key_hash, notified_at) VALUES (?, ?, ?)",
+                [(line_user_id, _key_hash(k), now) for k in keys],
+            )
+            conn.execute(
+                "DELETE FROM notified WHERE line_user_id = ? AND key_hash IN ("
+                "SELECT key_hash FROM notified WHERE line_user_id = ? "
+                "ORDER BY notified_at DESC LIMIT -1 OFFSET ?) OR (line_user_id = ? AND notified_at < ?)",
+                (line_user_id, line_user_id, NOTIFIED_CACHE_SIZE, line_user_id, now - NOTIFIED_TTL),
+            )
+
+    def buffer_digest(self, line_user_id, subjects, others, due_at):
+        # まとめ通知にメールを追加し、たまっているメールの件数を返す
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO digest (line_user_id, subjects, others, due_at) VALUES (?, ?, ?, ?)",
+                (line_user_id, json.dumps(subjects, ensure_ascii=False), others, due_at),
+            )
+            rows = conn.execute(
+                "SELECT subjects, others FROM digest WHERE line_user_id = ?", (line_user_id,)
+            ).fetchall()
+        return sum(len(json.loads(row[0])) + row[1] for row in rows)
+
+    def digest_due(self, now=None):
+        # 最初にためたメールの送信時刻を過ぎたユーザー
+        rows = self._conn().execute(
+            "SELECT DISTINCT line_user_id FROM digest WHERE due_at <= ?", (now or time.time(),)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def take_digest(self, line_user_id):
+        # ためていたメールを古い順に取り出して消す。戻り値: ([差出人, 件名] の一覧, それ以外の件数)
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT subjects, others FROM digest WHERE line_user_id = ? ORDER BY id", (line_user_id,)
+            ).fetchall()
+            conn.execute("DELETE FROM digest WHERE line_user_id = ?", (line_user_id,))
+        subjects = [subject for row in rows for subject in json.loads(row[0])]
+        return subjects, sum(row[1] for row in rows)
+
+    def create_job(self, job_id, requested, targets, not_found, active_since):
+        # ジョブを登録する。全員のチェック（requested が None）は同時に1件だけで、
+        # active_since 以降に登録された未完了のものがあれば登録せずにその ID を返す。
+        # 戻り値: (ジョブ ID, 登録したか)
+        now = time.time()
+        with self.transaction() as conn:
+            if requested is None:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE requested IS NULL AND finished_at IS NULL AND created_at >= ? "
+                    "ORDER BY created_at LIMIT 1",
+                    (active_since,),
+                ).fetchone()
+                if row:
+                    return row[0], False
+            if random.random() < 0.01:
+                conn.execute(
+                    "DELETE FROM job_results WHERE job_id IN (SELECT id FROM jobs WHERE created_at < ?)", (now - JOB_TTL,)
+                )
+                conn.execute("DELETE FROM jobs WHERE created_at < ?", (now - JOB_TTL,))
+            conn.execute(
+                "INSERT INTO jobs (id, requested, targets, total, checked, created_at, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    None if requested is None else json.dumps(requested),
+                    json.dumps(targets),
+                    len(targets),
+                    len(not_found),
+                    now,
+                    now if len(not_found) >= len(targets) else None,
+                ),
+            )
+            conn.executemany(
+                "INSERT INTO job_results (job_id, line_user_id, outcome, claimed_at) VALUES (?, ?, 'not_found', ?)",
+                [(job_id, uid, now) for uid in not_found],
+            )
+        return job_id, True
+
+    def get_job(self, job_id):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT requested, targets, created_at, started_at, finished_at FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        rows = conn.execute(
+            "SELECT line_user_id, outcome, new_mail, seconds, worker_id FROM job_results WHERE job_id = ?", (job_id,)
+        )
+        return {
+            "id": job_id,
+            "requested": None if row[0] is None else json.loads(row[0]),
+            "targets": json.loads(row[1]),
+            "created_at": row[2],
+            "started_at": row[3],
+            "finished_at": row[4],
+            "results": {
+                r[0]: {"outcome": r[1], "new_mail": r[2], "seconds": r[3], "worker_id": r[4]} for r in rows
+            },
+        }
+
+    def pending_jobs(self, active_since, stale_before):
+        # active_since 以降に登録された未完了のジョブと、まだ誰も取り出していないユーザーを古い順に返す。
+        # stale_before より前に取り出されたまま結果のないユーザーは、取り出し直せるように戻す
+        conn = self._conn()
+        conn.execute("DELETE FROM job_results WHERE outcome IS NULL AND claimed_at < ?", (stale_before,))
+        jobs = conn.execute(
+            "SELECT id, targets FROM jobs WHERE finished_at IS NULL AND created_at >= ? ORDER BY created_at",
+            (active_since,),
+        ).fetchall()
+        pending = []
+        for job_id, targets in jobs:
+            taken = {row[0] for row in conn.execute("SELECT line_user_id FROM job_results WHERE job_id = ?", (job_id,))}
+            pending.append((job_id, [uid for uid in json.loads(targets) if uid not in taken]))
+        return pending
+
+    def claim_job_users(self, job_id, line_user_ids, worker_id):
+        # ジョブのユーザーを取り出す（他のプロセスが取り出し済みのものは除く）。取り出せたユーザーを返す
+        now = time.time()
+        claimed = []
+        with self.transaction() as conn:
+            for uid in line_user_ids:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO job_results (job_id, line_user_id, worker_id, claimed_at) VALUES (?, ?, ?, ?)",
+                    (job_id, uid, worker_id, now),
+                )
+                if cur.rowcount == 1:
+                    claimed.append(uid)
+            if claimed:
+                conn.execute("UPDATE jobs SET started_at = COALESCE(started_at, ?) WHERE id = ?", (now, job_id))
+        return claimed
+
+    def release_job_users(self, job_id, line_user_ids):
+        # 取り出したもののチェックしなかったユーザーを戻す（次の周回・他のプロセスで取り出される）
+        with self.transaction() as conn:
+            conn.executemany(
+                "DELETE FROM job_results WHERE job_id = ? AND line_user_id = ? AND outcome IS NULL",
+                [(job_id, uid) for uid in line_user_ids],
+            )
+
+    def record_job_result(self, job_id, line_user_id, outcome, new_mail, seconds):
+        # 結果を保存し、全員分そろったらジョブを完了にする
+        now = time.time()
+        with self.transaction() as conn:
+            cur = conn.execute(
+                "UPDATE job_results SET outcome = ?, new_mail = ?, seconds = ? "
+                "WHERE job_id = ? AND line_user_id = ? AND outcome IS NULL",
+                (outcome, new_mail, seconds, job_id, line_user_id),
+            )
+            if cur.rowcount != 1:
+                return
+            conn.execute("UPDATE jobs SET checked = checked + 1 WHERE id = ?", (job_id,))
+            conn.execute(
+                "UPDATE jobs SET finished_at = ? WHERE id = ? AND finished_at IS NULL AND checked >= total",
+                (now, job_id),
+            )
+
+    def migrate_from_json(self, json_path):
+        # 旧 users.json からの一度きりの移行。移行後のファイルは .migrated に改名する
+        try:
+            with open(json_path, "r") as f:
+                users = json.load(f)
+        except FileNotFoundError:
+            return 0
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO users (line_user_id, state, email_address, data) VALUES (?, ?, ?, ?)",
+                [self._row(user) for user in users if user.get("LINE_USER_ID")],
+            )
+        try:
+            os.replace(json_path, json_path + ".migrated")
+        except FileNotFoundError:
+            # 別のワーカーが先に移行を終えている
+            pass
+        print(f"✅ {json_path} から {len(users)} 件のユーザーを移行しました")
+        return len(users)